@@ -1,12 +1,20 @@
 import os.path
+import io
+import inspect
+import csv
 import json
 from werkzeug.serving import run_simple
 from werkzeug.wrappers import Response
 from aureus.wsgi_adapter import wsgi_app
+from aureus.asgi_adapter import ASGIApp, run_sync, iter_sync, run_in_thread
+from aureus.server import serve
+from aureus.metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from aureus.helper import parse_static_key
-from aureus.route import Route
-from aureus.template_engine import replace_template
-from aureus.session import create_session_id, session
+from aureus.static import StaticCache, FileResponse, AssetManifest, stat_entry, IMMUTABLE_CACHE_CONTROL
+from aureus.compress import Compressor
+from aureus.route import Route, Router, parse_rule_args
+from aureus.template_engine import replace_template, stream_template as stream_replace_template, template_cache
+from aureus.session import create_session_id, session, SQLiteBackend
 import aureus.exceptions as exceptions
 
 
@@ -19,12 +27,104 @@ TYPE_MAP = {
     'jpeg': 'image/jpeg'
 }
 
+# 默认响应体类型
+CONTENT_TYPE = 'text/html; charset=UTF-8'
+
+# 多进程服务器的参数，见 aureus.server.Arbiter
+SERVER_OPTIONS = ('threads', 'max_requests', 'max_requests_jitter', 'keep_alive', 'graceful_timeout', 'reuse_port', 'backlog')
+
+# 默认响应报头，定义响应报头的 Server 属性
+DEFAULT_HEADERS = [('Server', 'AUREUS Web 0.1')]
+
 # 处理函数数据结构
 class ExecFunc:
     def __init__(self, func, func_type, **options):
         self.func = func            # 处理函数
         self.options = options      # 附带参数
         self.func_type = func_type  # 函数类型
+        self.invoke = None          # 预编译的调用入口，参数为 (request, params)
+        self.invoke_async = None    # 异步处理函数的异步调用入口，参数与 invoke 相同
+        self.is_async = False       # 处理函数是否为异步函数
+
+    # 把处理函数冻结为专用的调用入口，调用约定在注册时就确定下来，请求期不再做任何内省
+    def compile(self, args=()):
+        func = self.func
+
+        if self.func_type == 'route':
+            # 除路径参数外还有多余的参数时，第一个参数为请求体
+            if func.__code__.co_argcount > len(args):
+                # 需要附带请求体进行结果处理
+                call = lambda request, params: func(request, **params)
+            else:
+                # 不需要附带请求体进行结果处理
+                call = lambda request, params: func(**params)
+
+            self.is_async = inspect.iscoroutinefunction(func)
+        elif self.func_type == 'view':
+            # 所有视图处理函数都需要附带请求体来获取处理结果，路径参数以关键字参数传给视图的 dispatch_request
+            call = lambda request, params: func(request, **params)
+
+            self.is_async = func.view_class.is_async()
+        elif self.func_type == 'static':
+            # 静态资源返回的是一个预先封装好的响应体，所以直接返回，这里的 params 为资源路径
+            self.invoke = lambda request, params: func(params, request)
+            return self.invoke
+        else:
+            # 未知类型在请求时抛出未知处理类型异常
+            def invoke(request, params):
+                raise exceptions.UnknownFuncError
+
+            self.invoke = invoke
+            return invoke
+
+        # 把处理函数的返回值封装为响应体
+        def finish(request, rep):
+            # 判断如果返回值是一个 Response 类型，则直接放回
+            if isinstance(rep, Response):
+                return rep
+
+            # 如果 session_id 这个键不在 cookies 中，则通知客户端设置 Cookie，create_session_id 是生成一个无规律唯一字符串的方法
+            # 签名 Cookie 会话不使用 Session ID，不需要设置
+            if session.cookie_store is None and 'session_id' not in request.cookies:
+                headers = DEFAULT_HEADERS + [('Set-Cookie', 'session_id=%s' % create_session_id())]
+            else:
+                headers = DEFAULT_HEADERS
+
+            # 异步迭代的返回值（例如长轮询的异步生成器）原样透传，由 ASGI 模块逐块发送
+            if hasattr(rep, '__aiter__'):
+                return Response(rep, content_type=CONTENT_TYPE, headers=headers, status=200, direct_passthrough=True)
+
+            # 回传实现 WSGI 规范的响应体给 WSGI 模块
+            return Response(rep, content_type=CONTENT_TYPE, headers=headers, status=200)
+
+        if not self.is_async:
+            def invoke(request, params):
+                return finish(request, call(request, params))
+
+            self.invoke = invoke
+            return invoke
+
+        # 异步处理函数，视图的调度入口可能是同步函数，返回的是协程
+        async def invoke_async(request, params):
+            rep = call(request, params)
+
+            if inspect.isawaitable(rep):
+                rep = await rep
+
+            return finish(request, rep)
+
+        # 在 WSGI 下调用时，在当前线程的事件循环中执行，异步迭代的响应内容转为同步生成器
+        def invoke(request, params):
+            response = run_sync(invoke_async(request, params))
+
+            if hasattr(response.response, '__aiter__'):
+                response.response = iter_sync(response.response)
+
+            return response
+
+        self.invoke = invoke
+        self.invoke_async = invoke_async
+        return invoke
 
 class AUREUS:            
 
@@ -32,15 +132,42 @@ class AUREUS:
     def __init__(self, static_folder='static', template_folder='template', session_path=".session"):
         self.host = '127.0.0.1'  # 默认主机
         self.port = 8080  # 默认端口
-        self.url_map = {} # 存放 URL 与 Endpoint 的映射
+        self.url_map = {} # 存放 URL 与 Endpoint 的映射，格式为 URL -> {请求方法: Endpoint}
+        self.router = Router() # 编译型路由表，支持路径参数与按请求方法分发
         self.static_map = {} # 存放 URL 与 静态资源的映射
+        self.static_cache = StaticCache() # 静态资源内存缓存
+        self.compressor = Compressor() # 响应压缩器，设置为 None 时关闭压缩
+        self.fingerprint = True # 是否为静态资源生成带指纹的 URL，并对其启用永久缓存
+        self.asset_manifest = AssetManifest() # 静态资源指纹清单
+        AUREUS.asset_manifest = self.asset_manifest # 为类的 asset_manifest 也初始化，供模版引擎与 asset_url 调用
         self.function_map = {} # 存放 Endpoint 与请求处理函数的映射
         self.static_folder = static_folder # 静态资源本地存放路径，默认放在应用所在目录的 static 文件夹下
         self.template_folder = template_folder # 模版文件本地存放路径，默认放在应用所在目录的 template 目录下
         AUREUS.template_folder = self.template_folder # 为类的 template_folder 也初始化，供上面的置换模版引擎调用
+        self.precompile_templates = False # 是否在启动时预编译模版目录中的全部模版
         self.session_path = session_path   # 会话记录默认存放在应用同目录下的 .session 文件夹中
+        self.session_backend = None   # 会话存储后端，为空时沿用 session 上已设置的存储后端，都没有时使用会话记录目录下的 SQLite 数据库
+        self.session_background = False   # 是否由后台线程写入会话，请求延迟中不再包含存储后端写入的时间
+        self.prepared = False   # 是否已完成启动前的准备工作
+        self.async_workers = 32   # ASGI 下执行同步处理函数的线程数
+        self.executor = None   # ASGI 下执行同步处理函数的线程池，第一次使用时创建
+        self.asgi_app = ASGIApp(self)  # ASGI 调用入口，例如 uvicorn main:app.asgi_app
+        self.metrics_url = None   # 以 Prometheus 文本格式输出运行指标的 URL，例如 '/metrics'，为空时不输出
         self.route = Route(self)  # 路由装饰器
 
+    # 以 Prometheus 文本格式输出运行指标的 URL
+    @property
+    def metrics_url(self):
+        return self.metrics_path
+
+    # 设置输出运行指标的 URL 时开启指标记录，不输出时请求不承担记录的开销
+    @metrics_url.setter
+    def metrics_url(self, url):
+        self.metrics_path = url
+
+        if url:
+            metrics.enabled = True
+
     # 添加视图规则
     def bind_view(self, url, view_class, endpoint):
         self.add_url_rule(url, func=view_class.get_func(endpoint), func_type='view')
@@ -66,8 +193,11 @@ class AUREUS:
         if endpoint is None:
             endpoint = func.__name__
 
-        # 抛出 URL 已存在异常
-        if url in self.url_map:
+        # 获取支持的请求方法，视图类型由视图内部分发，不限制请求方法
+        methods = options.get('methods') if func_type == 'route' else None
+
+        # 抛出 URL 已存在异常，同一个 URL 只有在请求方法没有交集时才允许重复绑定
+        if self.router.conflict(url, methods):
             raise exceptions.URLExistsError
 
         # 如果类型不是静态资源，并且节点已存在，则抛出节点已存在异常
@@ -75,123 +205,167 @@ class AUREUS:
             raise exceptions.EndpointExistsError
 
         # 添加 URL 与节点映射
-        self.url_map[url] = endpoint
+        for method in (methods or ['*']):
+            self.url_map.setdefault(url, {})[method.upper()] = endpoint
+
+        # 添加路由规则，路由树会在启动时或第一次请求时统一编译
+        self.router.add(url, endpoint, methods)
 
-        # 添加节点与请求处理函数映射
-        self.function_map[endpoint] = ExecFunc(func, func_type, **options)
+        # 添加节点与请求处理函数映射，并预编译调用入口
+        exec_function = ExecFunc(func, func_type, **options)
+        exec_function.compile(parse_rule_args(url))
+        self.function_map[endpoint] = exec_function
 
     # 静态资源调路由
     @exceptions.capture
-    def dispatch_static(self, static_path):
-        # 判断资源文件是否在静态资源规则中，如果不存在，返回 404 状态页
-        if os.path.exists(static_path):
-            # 获取资源文件后缀
-            key = parse_static_key(static_path)
+    def dispatch_static(self, static_path, request=None):
+        headers = {}
 
-            # 获取文件类型
-            doc_type = TYPE_MAP.get(key, 'text/plain')
+        # 带指纹的资源还原为实际文件路径，并允许客户端永久缓存
+        real_path = self.asset_manifest.resolve(static_path)
+        if real_path is not None:
+            static_path = real_path
+            headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
 
-            # 获取文件内容
-            with open(static_path, 'rb') as f:
-                rep = f.read()
+        # 从静态资源缓存中获取资源，如果不存在，返回 404 状态页
+        entry = self.static_cache.get(static_path)
 
-            # 封装并返回响应体
-            return Response(rep, content_type=doc_type)
-        else:
+        if entry is None:
             # 抛出页面未找到异常
             raise exceptions.PageNotFoundError
 
-    # 路由
-    @exceptions.capture
-    def dispatch_request(self, request):
+        # 获取资源文件后缀
+        key = parse_static_key(static_path)
 
-        # 去掉 URL 中 域名部分，也就从 http://xxx.com/path/file?xx=xx 中提取 path/file 这部分
-        url = "/" + "/".join(request.url.split("/")[3:]).split("?")[0]
+        # 获取文件类型
+        doc_type = TYPE_MAP.get(key, 'text/plain')
 
-        # 通过 URL 寻找节点名
-        if url.find(self.static_folder) == 1 and url.index(self.static_folder) == 1:
-            # 如果 URL 以静态资源文件夹名首目录，则资源为静态资源，节点定义为 static
-            endpoint = 'static'
-            url = url[1:]
-        else:  
-            # 若不以 static 为首，则从 URL 与 节点的映射表中获取节点
-            endpoint = self.url_map.get(url, None)
+        # 按客户端接受的编码选出预压缩文件或压缩后的缓存版本
+        if self.compressor is not None and request is not None:
+            entry, encoding = self.compressor.static_variant(self.static_cache, entry, request.environ, doc_type)
 
-        # 如果节点为空，抛出页面未找到异常
-        if endpoint is None:
-            raise exceptions.PageNotFoundError
+            # 可压缩的资源需要声明按 Accept-Encoding 区分缓存
+            if self.compressor.compressible(doc_type):
+                headers['Vary'] = 'Accept-Encoding'
 
-        # 获取节点对应的执行函数
-        exec_function = self.function_map[endpoint]
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
 
-        # 判断执行函数类型
-        if exec_function.func_type == 'route':
-            """ 路由处理 """  
+        # 封装并返回响应体，条件请求与 Range 请求在响应交给 WSGI 服务器时处理
+        return FileResponse(entry, content_type=doc_type, headers=headers)
 
-            # 判断请求方法是否支持
-            if request.method in exec_function.options.get('methods'):
-                """ 路由处理结果 """
+    # 以 Prometheus 文本格式输出运行指标
+    def dispatch_metrics(self, request):
+        return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE, headers=DEFAULT_HEADERS)
 
-                # 判断路由的执行函数是否需要请求体进行内部处理
-                argcount = exec_function.func.__code__.co_argcount
+    # 注册会话与静态资源缓存的指标，多进程运行时按进程汇总
+    def register_metrics(self):
+        metrics.register('aureus_sessions', 'Sessions held in memory', lambda: session.stats()['live'])
+        metrics.register('aureus_sessions_evicted_total', 'Sessions evicted from memory', lambda: session.stats()['evicted'], 'counter')
+        metrics.register('aureus_sessions_expired_total', 'Expired sessions removed', lambda: session.stats()['expired'], 'counter')
+        metrics.register('aureus_static_cache_entries', 'Static files held in the memory cache', lambda: self.static_cache.stats()['entries'])
+        metrics.register('aureus_static_cache_bytes', 'Bytes held in the static file cache', lambda: self.static_cache.stats()['bytes'])
+        metrics.register('aureus_static_cache_hits_total', 'Static file cache hits', lambda: self.static_cache.stats()['hits'], 'counter')
+        metrics.register('aureus_static_cache_misses_total', 'Static file cache misses', lambda: self.static_cache.stats()['misses'], 'counter')
+        metrics.register('aureus_static_cache_evictions_total', 'Static file cache evictions', lambda: self.static_cache.stats()['evictions'], 'counter')
 
-                if argcount > 0:
-                    # 需要附带请求体进行结果处理
-                    rep = exec_function.func(request)
-                else:
-                    # 不需要附带请求体进行结果处理
-                    rep = exec_function.func()
-            else:
-                """ 未知请求方法 """
+    # 编译路由表，在启动时调用，若应用直接交给其它 WSGI 服务器运行，则在第一次请求时调用
+    def compile(self):
+        # 静态资源 URL 前缀，以此前缀开头的请求直接交给静态资源处理，不经过路由树
+        self.static_prefix = '/%s/' % self.static_folder.strip('/')
+
+        # 计算静态资源指纹清单
+        if self.fingerprint:
+            self.asset_manifest.build(self.static_folder)
 
-                # 抛出请求方法不支持异常
-                raise exceptions.InvalidRequestMethodError
+        # 映射静态资源处理函数，所有静态资源处理函数都是静态资源路由
+        self.function_map['static'] = ExecFunc(func=self.dispatch_static, func_type='static')
+        self.function_map['static'].compile()
 
-        elif exec_function.func_type == 'view':
-            """ 视图处理结果 """
+        # 运行指标处理函数不放入节点映射，避免与同名的处理函数冲突，同时注册会话与静态资源缓存的指标
+        self.metrics_function = ExecFunc(func=self.dispatch_metrics, func_type='route')
+        self.metrics_function.compile()
+        self.register_metrics()
 
-            # 所有视图处理函数都需要附带请求体来获取处理结果
-            rep = exec_function.func(request)
-        elif exec_function.func_type == 'static':
-            """ 静态逻辑处理 """
+        # 编译路由树
+        self.router.compile()
 
-            # 静态资源返回的是一个预先封装好的响应体，所以直接返回
-            return exec_function.func(url)
-        else:
-            """ 未知类型处理 """
+    # 匹配请求对应的处理函数，返回 (处理函数, 参数)，静态资源的参数为资源路径
+    def match_request(self, request):
 
-            # 抛出未知处理类型异常
-            raise exceptions.UnknownFuncError
+        # 路由表尚未编译或有新规则加入时先编译
+        if not self.router.compiled:
+            self.compile()
 
-        # 定义 200 状态码表示成功
-        status = 200
-        # 定义响应体类型
-        content_type = 'text/html'
+        # 请求路径直接取自 WSGI 环境的 PATH_INFO，WSGI 规范中它以 latin-1 编码传递，需要还原为 UTF-8
+        url = request.environ.get('PATH_INFO') or '/'
+        try:
+            url = url.encode('latin-1').decode('utf-8')
+        except UnicodeError:
+            pass
 
-        # 从请求中取出 Cookie
-        cookies = request.cookies
+        # 运行指标，不经过路由树
+        if url == self.metrics_url:
+            request.endpoint = 'metrics'
+            return self.metrics_function, {}
 
-        # 如果 session_id 这个键不在 cookies 中，则通知客户端设置 Cookie
-        if 'session_id' not in cookies:
-            headers = {
-                'Set-Cookie': 'session_id=%s' % create_session_id(), # 定义 Set-Cookie属性，通知客户端记录 Cookie，create_session_id 是生成一个无规律唯一字符串的方法
-                'Server': 'AUREUS Web 0.1'   # 定义响应报头的 Server 属性
-            }
-        else:
-            # 定义响应报头的 Server 属性
-            headers = {
-                'Server': 'AUREUS Web 0.1'
-            }
+        # 如果 URL 以静态资源文件夹名首目录，则资源为静态资源，直接交给静态资源处理函数
+        if url.startswith(self.static_prefix):
+            request.endpoint = 'static'
+            return self.function_map['static'], url[1:]
+
+        # 从路由树中获取节点与路径参数，找不到时抛出页面未找到或请求方法不支持异常
+        endpoint, params = self.router.match(url, request.method)
 
-        # 判断如果返回值是一个 Response 类型，则直接放回
-        if isinstance(rep, Response):
-            return rep
+        # 记录匹配到的节点，供请求级别的统计使用
+        request.endpoint = endpoint
+
+        return self.function_map[endpoint], params
+
+    # 路由
+    @exceptions.capture
+    def dispatch_request(self, request):
+        exec_function, params = self.match_request(request)
+
+        # 调用节点对应的预编译入口
+        response = exec_function.invoke(request, params)
+
+        # 静态资源已按编码处理过，不再压缩
+        if exec_function.func_type == 'static':
+            return response
+
+        # 按客户端接受的编码压缩响应体
+        if self.compressor is not None:
+            response = self.compressor.compress_response(request.environ, response)
 
         # 回传实现 WSGI 规范的响应体给 WSGI 模块
-        return Response(rep, content_type='%s; charset=UTF-8' % content_type, headers=headers, status=status)
-        
+        return response
+
+    # 异步路由，异步处理函数直接在事件循环中执行，同步处理函数在线程池中执行，不阻塞事件循环
+    @exceptions.capture_async
+    async def dispatch_request_async(self, request):
+        exec_function, params = self.match_request(request)
+
+        if exec_function.is_async:
+            response = await exec_function.invoke_async(request, params)
+        else:
+            response = await run_in_thread(self, exec_function.invoke, request, params)
+
+        # 静态资源已按编码处理过，不再压缩
+        if exec_function.func_type == 'static':
+            return response
+
+        # 按客户端接受的编码压缩响应体
+        if self.compressor is not None:
+            response = self.compressor.compress_response(request.environ, response)
+
+        return response
+
     # 启动入口
-    def run(self, host=None, port=None, **options):
+    def run(self, host=None, port=None, workers=None, **options):
+        # 多进程服务器的参数，不作为应用属性
+        server_options = {key: options.pop(key) for key in SERVER_OPTIONS if key in options}
+
         # 如果有参数进来且值不为空，则赋值
         for key, value in options.items():
           if value is not None:
@@ -205,21 +379,48 @@ class AUREUS:
         if port:
             self.port = port
 
-        # 映射静态资源处理函数，所有静态资源处理函数都是静态资源路由
-        self.function_map['static'] = ExecFunc(func=self.dispatch_static, func_type='static')
+        # 完成启动前的准备工作
+        self.prepare()
+
+        # 指定了工作进程数量时使用多进程服务器，为 0 时按 CPU 核数创建
+        if workers is not None:
+            # 各工作进程共享会话存储后端，内存中的会话需要与存储后端核对
+            session.shared = True
+
+            # 各工作进程的运行指标通过会话记录目录下的 SQLite 数据库汇总
+            if self.metrics_url:
+                metrics.use_store(os.path.join(self.session_path, 'metrics.db'), reset=True, start=False)
+
+            serve(self, self.host, self.port, workers, **server_options)
+            return
+
+        # 把框架本身也就是应用本身和其它几个配置参数传给 werkzeug 的 run_simple
+        run_simple(hostname=self.host, port=self.port, application=self, **options)
+
+    # 启动前的准备工作，编译路由表与模版，设置会话存储后端
+    def prepare(self):
+        # 编译路由表
+        self.compile()
+
+        # 预编译全部模版，第一次请求不再需要编译模版
+        if self.precompile_templates:
+            template_cache.precompile(self.template_folder)
 
          # 如果会话记录存放目录不存在，则创建它
         if not os.path.exists(self.session_path):
             os.mkdir(self.session_path)
 
-        # 设置会话记录存放目录
-        session.set_storage_path(self.session_path)
+        # 设置会话存储后端，默认把全部会话存放在会话记录目录下的单个 SQLite 数据库文件中，会话在第一次被访问时才加载
+        # 使用签名 Cookie 会话时不需要存储后端
+        if session.cookie_store is None:
+            if self.session_backend is None:
+                self.session_backend = session.backend or SQLiteBackend(os.path.join(self.session_path, 'session.db'))
 
-        # 加载本地缓存的 session 记录
-        session.load_local_session()
+            # 只在存储后端变化或需要开启后台写入时重新设置，直接在 session 上设置的存储后端与后台写入线程保持不变
+            if session.backend is not self.session_backend or self.session_background and session.writer is None:
+                session.set_backend(self.session_backend, background=self.session_background)
 
-        # 把框架本身也就是应用本身和其它几个配置参数传给 werkzeug 的 run_simple
-        run_simple(hostname=self.host, port=self.port, application=self, **options)
+        self.prepared = True
       
     # 框架被 WSGI 调用入口的方法
     def __call__(self, environ, start_response):
@@ -229,6 +430,14 @@ class AUREUS:
 def simple_template(path, **options):
     return replace_template(AUREUS, path, **options)
 
+# 流式模版引擎接口，返回的分块生成器可以直接作为路由的返回值，页面会边渲染边发送
+def stream_template(path, **options):
+    return stream_replace_template(AUREUS, path, **options)
+
+# 获取静态资源带指纹的 URL，参数为相对静态资源目录的路径，例如 asset_url('css/app.css')
+def asset_url(name):
+    return AUREUS.asset_manifest.url(name)
+
 # URL 重定向方法
 def redirect(url, status_code=302):
     # 定义一个响应体
@@ -257,6 +466,64 @@ def render_json(data):
     # 返回封装完的响应体
     return Response(data, content_type="%s; charset=UTF-8" % content_type, status=200)
 
+# 流式导出时缓冲区超过该字符数就立即输出
+EXPORT_BUFFER_SIZE = 65536
+
+# 把逐行数据编码为 CSV 分块，行可以是字典或序列，columns 为空时以第一行字典的键作为表头
+def iter_csv(rows, columns=None):
+    buffer = io.StringIO()
+    writer = None
+
+    for row in rows:
+        if writer is None:
+            if columns is None and isinstance(row, dict):
+                columns = list(row)
+
+            writer = csv.writer(buffer)
+
+            if columns is not None:
+                writer.writerow(columns)
+
+        writer.writerow([row.get(column) for column in columns] if isinstance(row, dict) else row)
+
+        # 缓冲区过大时立即输出
+        if buffer.tell() >= EXPORT_BUFFER_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+# 把逐行数据编码为 JSON 数组分块，无法直接序列化的值（时间、Decimal 等）转为字符串
+def iter_json(rows):
+    parts = ['[']
+    size = 1
+    separator = ''
+
+    for row in rows:
+        data = separator + json.dumps(row, default=str)
+        parts.append(data)
+        size += len(data)
+        separator = ','
+
+        # 缓冲区过大时立即输出
+        if size >= EXPORT_BUFFER_SIZE:
+            yield ''.join(parts).encode()
+            parts, size = [], 0
+
+    parts.append(']')
+    yield ''.join(parts).encode()
+
+# 以 CSV 格式流式返回数据，通常配合 BaseDB.stream 导出大结果集，指定文件名时作为附件下载
+def stream_csv(rows, file_name=None, columns=None):
+    headers = {'Content-Disposition': 'attachment; filename="%s"' % file_name} if file_name else None
+    return Response(iter_csv(rows, columns), content_type='text/csv; charset=UTF-8', headers=headers)
+
+# 以 JSON 数组格式流式返回数据
+def stream_json(rows):
+    return Response(iter_json(rows), content_type='application/json; charset=UTF-8')
+
 # 返回让客户端保存文件到本地的响应体
 @exceptions.capture
 def render_file(file_path, file_name=None):
@@ -268,11 +535,10 @@ def render_file(file_path, file_name=None):
         if not os.access(file_path, os.R_OK):
             raise exceptions.RequireReadPermissionError
 
-        # 读取文件内容
-        with open(file_path, "rb") as f:
-            content = f.read()
+        # 读取文件元信息，文件内容在发送时以文件句柄流式读取，不会整个载入内存
+        entry = stat_entry(file_path)
 
-        # 如果没有设置文件名，则以 “/” 分割路径取最后一项最为文件名
+        # 如果没有设置文件名，则以 “/” 分割路径取最后一项最为文件名
         if file_name is None:
             file_name = file_path.split("/")[-1]
 
@@ -281,8 +547,8 @@ def render_file(file_path, file_name=None):
             'Content-Disposition': 'attachment; filename="%s"' % file_name
         }
 
-        # 返回响应体
-        return Response(content, headers=headers, status=200)
+        # 返回响应体，支持断点续传
+        return FileResponse(entry, headers=headers)
 
     # 如果不存在该文件，抛出文件不存在异常
     raise exceptions.FileNotExistsError
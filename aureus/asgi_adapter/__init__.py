@@ -0,0 +1,240 @@
+import sys
+import asyncio
+import threading
+import contextvars
+from io import BytesIO
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wrappers import Request
+from aureus.session import session, DIRTY_KEY
+from aureus.profiler import profiler
+from aureus.metrics import metrics, endpoint_of
+from aureus.static import FileResponse
+
+
+# 请求体超过该字节数时写入临时文件
+MAX_MEMORY_BODY = 1024 * 1024
+
+# 每个线程自己的事件循环，用于在 WSGI 下执行异步处理函数
+local = threading.local()
+
+# 在当前线程的事件循环中执行协程并返回结果
+def run_sync(coro):
+    loop = getattr(local, 'loop', None)
+
+    if loop is None:
+        loop = local.loop = asyncio.new_event_loop()
+
+    return loop.run_until_complete(coro)
+
+# 把异步迭代器转换为同步生成器，WSGI 服务器可以直接迭代异步处理函数返回的响应内容
+def iter_sync(iterable):
+    iterator = iterable.__aiter__()
+
+    try:
+        while True:
+            try:
+                yield run_sync(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        if hasattr(iterator, 'aclose'):
+            run_sync(iterator.aclose())
+
+# 获取应用执行同步处理函数的线程池
+def get_executor(app):
+    if app.executor is None:
+        app.executor = ThreadPoolExecutor(max_workers=app.async_workers, thread_name_prefix='aureus')
+
+    return app.executor
+
+# 在线程池中执行同步函数，携带当前上下文，会话与查询统计依然归属当前请求
+async def run_in_thread(app, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(app), partial(contextvars.copy_context().run, func, *args))
+
+# 读取完整的请求体，较大的请求体写入临时文件
+async def read_body(receive):
+    message = await receive()
+    body = message.get('body', b'')
+
+    # 只有一个分块时直接放在内存中
+    if not message.get('more_body', False):
+        return BytesIO(body)
+
+    buffer = SpooledTemporaryFile(max_size=MAX_MEMORY_BODY)
+    buffer.write(body)
+
+    while message.get('more_body', False):
+        message = await receive()
+        buffer.write(message.get('body', b''))
+
+    buffer.seek(0)
+    return buffer
+
+# 把 ASGI 连接信息转换为 WSGI 环境，路由、会话、静态资源等逻辑都可以直接复用
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.input_terminated': True,      # 请求体已完整读取，没有 Content-Length 的分块请求也可以直接读到结尾
+        'asgi.scope': scope
+    }
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+
+        # 重复的报头合并为一个，Cookie 以分号分隔
+        if key in environ:
+            environ[key] += ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        else:
+            environ[key] = value
+
+    return environ
+
+# 发送响应，同步迭代的响应内容（文件、生成器）在线程池中逐块读取，异步迭代的响应内容直接在事件循环中读取
+# request_metrics 为请求的指标记录，在开始发送时记录状态码，没有 Content-Length 的响应在发送完后记录大小
+async def send_response(app, environ, response, headers, send, request_metrics=None, endpoint=None):
+    app_iter, status, response_headers = response.get_wsgi_response(environ)
+    count = metrics.record(request_metrics, endpoint, environ['REQUEST_METHOD'], int(status.split(' ', 1)[0]), response_headers)
+    size = 0
+
+    await send({
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in list(response_headers) + headers]
+    })
+
+    try:
+        if hasattr(app_iter, '__aiter__'):
+            async for chunk in app_iter:
+                if chunk:
+                    size += len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        elif response.is_sequence and not isinstance(response, FileResponse):
+            # 内容已经在内存中，直接发送
+            body = b''.join(app_iter)
+            size = len(body)
+            if body:
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        else:
+            iterator = iter(app_iter)
+
+            while True:
+                chunk = await run_in_thread(app, next, iterator, None)
+
+                if chunk is None:
+                    break
+
+                if chunk:
+                    size += len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(app_iter, 'aclose'):
+            await app_iter.aclose()
+        elif hasattr(app_iter, 'close'):
+            app_iter.close()
+
+        if count:
+            metrics.observe_size(endpoint, size)
+
+# 处理生命周期事件，启动时完成路由编译与会话存储等准备工作
+async def lifespan(app, receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            try:
+                await run_in_thread(app, app.prepare)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if app.executor is not None:
+                app.executor.shutdown(wait=False)
+                app.executor = None
+
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+# ASGI 调度框架入口
+async def asgi_app(app, scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(app, receive, send)
+
+    # 不支持 WebSocket，直接关闭连接
+    if scope['type'] == 'websocket':
+        await receive()
+        await send({'type': 'websocket.close', 'code': 1000})
+        return
+
+    # 服务器不发送生命周期事件时，在第一次请求时完成准备工作
+    if not app.prepared:
+        await run_in_thread(app, app.prepare)
+
+    # 解析请求头
+    request = Request(build_environ(scope, await read_body(receive)))
+
+    # 开始记录本次请求的指标，不能覆盖 ASGI 的 scope 参数
+    request_metrics = metrics.begin()
+
+    # 开始统计本次请求内的数据库查询
+    token = profiler.begin()
+
+    try:
+        # 把请求传给框架的路由进行处理，同步处理函数在线程池中执行
+        try:
+            response = await app.dispatch_request_async(request)
+        finally:
+            profiler.end(token, getattr(request, 'endpoint', None) or request.path)
+
+        # 请求修改过会话或者到达过期会话的清理时间时调用 flush，与 WSGI 一样写入会话并清理过期会话，存储后端的读写在线程池中执行
+        # 两者都没有时 flush 不做任何事，省去一次线程切换
+        headers = await run_in_thread(app, session.flush, request) if DIRTY_KEY in request.environ or session.sweep_due() else []
+    except Exception:
+        # 本次请求对会话的修改不再写入，解除未写入标记
+        session.discard(request)
+
+        # 没有被转换为响应体的异常，按 500 记录
+        metrics.record(request_metrics, endpoint_of(request), request.method, 500)
+        raise
+
+    await send_response(app, request.environ, response, headers, send, request_metrics, endpoint_of(request))
+
+# ASGI 应用入口，作为 AUREUS 的 asgi_app 属性交给 ASGI 服务器，例如 uvicorn main:app.asgi_app
+class ASGIApp:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        await asgi_app(self.app, scope, receive, send)
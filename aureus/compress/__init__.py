@@ -0,0 +1,154 @@
+import gzip
+import zlib
+from werkzeug.http import parse_accept_header
+
+# brotli 为可选依赖，未安装时只支持 gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# 值得压缩的非 text/* 文件类型
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml'
+}
+
+# 预压缩文件的后缀
+ENCODING_SUFFIX = {
+    'br': '.br',
+    'gzip': '.gz'
+}
+
+
+# 压缩数据
+def compress(data, encoding, level=6):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+
+    return gzip.compress(data, compresslevel=level)
+
+
+# 流式压缩，每个分块都立即刷新输出，保证流式响应的首字节不会被压缩缓冲区延迟
+def iter_gzip(iterable, level=6):
+    # wbits 为 31 时输出 gzip 格式
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    try:
+        for chunk in iterable:
+            if not chunk:
+                continue
+
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        yield compressor.flush()
+    finally:
+        # 关闭原始的响应迭代器
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+# 响应压缩器，负责协商 Accept-Encoding 并压缩动态响应与静态资源
+class Compressor:
+    def __init__(self, level=6, min_size=1024, precompressed=True):
+        self.level = level                  # 压缩级别
+        self.min_size = min_size            # 响应体小于该字节数时不压缩，压缩收益抵不上开销
+        self.precompressed = precompressed  # 是否优先使用静态资源目录中同名的 .br / .gz 文件
+
+        # 支持的编码，按优先级排列
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    # 判断文件类型是否值得压缩，图片、压缩包等已压缩的格式不再压缩
+    def compressible(self, mimetype):
+        return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES)
+
+    # 根据 Accept-Encoding 选出客户端接受的最优编码，没有可用编码时返回 None
+    def negotiate(self, environ, encodings=None):
+        value = environ.get('HTTP_ACCEPT_ENCODING')
+
+        if not value:
+            return None
+
+        accept = parse_accept_header(value)
+        best, best_quality = None, 0
+
+        for encoding in encodings or self.encodings:
+            quality = accept.quality(encoding)
+
+            # 质量相同时保留优先级更高的编码
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+
+        return best
+
+    # 压缩动态响应，流式响应逐块压缩，其它响应在超过阈值时整体压缩
+    def compress_response(self, environ, response):
+        # 已编码、直接透传或非 200 的响应不处理
+        if response.direct_passthrough or response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+
+        # 客户端没有声明接受的编码时不会压缩，不需要检查类型与读取响应体
+        if not environ.get('HTTP_ACCEPT_ENCODING'):
+            return response
+
+        if not self.compressible(response.mimetype):
+            return response
+
+        if response.is_streamed:
+            # 流式响应无法预知大小，只要客户端接受 gzip 就压缩
+            response.vary.add('Accept-Encoding')
+
+            if self.negotiate(environ, ('gzip',)) is None:
+                return response
+
+            response.response = iter_gzip(response.response, self.level)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers.pop('Content-Length', None)
+            return response
+
+        # 响应体过小时不压缩，只累加各分块的长度，不拼接响应体
+        length = response.calculate_content_length()
+        if length is not None and length < self.min_size:
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        # 动态响应只使用 gzip，brotli 的高压缩级别对每个请求来说开销过大
+        if self.negotiate(environ, ('gzip',)) is None:
+            return response
+
+        response.set_data(compress(response.get_data(), 'gzip', self.level))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    # 为静态资源选出合适的编码版本，返回 (缓存项, 编码)，编码为 None 时表示使用原始文件
+    def static_variant(self, cache, entry, environ, mimetype):
+        if not self.compressible(mimetype):
+            return entry, None
+
+        # 优先使用预压缩文件，预压缩文件比原始文件旧时视为过期
+        if self.precompressed:
+            encoding = self.negotiate(environ, tuple(ENCODING_SUFFIX))
+
+            if encoding is not None:
+                variant = cache.get(entry.path + ENCODING_SUFFIX[encoding])
+
+                if variant is not None and variant.mtime >= entry.mtime:
+                    return variant, encoding
+
+        # 没有预压缩文件时，压缩缓存中的文件内容，压缩结果随缓存项一起缓存
+        if entry.content is None or entry.size < self.min_size:
+            return entry, None
+
+        encoding = self.negotiate(environ)
+
+        if encoding is None:
+            return entry, None
+
+        return cache.variant(entry, encoding, lambda data: compress(data, encoding, self.level)), encoding
@@ -1,4 +1,25 @@
+import os
+import re
+import time
+import asyncio
+import threading
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from array import array
 import pymysql
+from pymysql.constants import FIELD_TYPE
+import aureus.exceptions as exceptions
+from aureus.profiler import profiler, fingerprint, current_scope
+
+# numpy 为可选依赖，未安装时列式结果集不能转换为 numpy 数组
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # 数据库返回结果对象
 class DBResult:
@@ -54,11 +75,648 @@ class DBResult:
             'rows': self.rows
         }
         
+# 整数与浮点数字段类型对应的 array 类型码，其它类型的字段以列表保存
+ARRAY_TYPECODES = {
+    FIELD_TYPE.TINY: 'q',
+    FIELD_TYPE.SHORT: 'q',
+    FIELD_TYPE.INT24: 'q',
+    FIELD_TYPE.LONG: 'q',
+    FIELD_TYPE.LONGLONG: 'q',
+    FIELD_TYPE.YEAR: 'q',
+    FIELD_TYPE.FLOAT: 'd',
+    FIELD_TYPE.DOUBLE: 'd'
+}
+
+# 列式结果集，字段名只保存一次，数值列保存在连续内存的 array 中，其它列保存在列表中
+# 按下标访问时返回该行的字典，与 DictCursor 的结果集用法相同
+class ColumnarResult:
+    def __init__(self, names, columns):
+        self.names = names          # 字段名列表
+        self.columns = columns      # 与字段名一一对应的列数据
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        return dict(zip(self.names, [column[index] for column in self.columns]))
+
+    def __iter__(self):
+        for values in zip(*self.columns):
+            yield dict(zip(self.names, values))
+
+    # 获取一列数据
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    # 把一列数据转为 numpy 数组，array 保存的数值列不复制数据，共用同一块内存
+    def to_numpy(self, name):
+        if numpy is None:
+            raise ImportError('numpy is required for to_numpy')
+
+        column = self.column(name)
+
+        if isinstance(column, array):
+            return numpy.frombuffer(column, dtype='int64' if column.typecode == 'q' else 'float64')
+
+        return numpy.array(column, dtype=object)
+
+    # 转为行字典列表
+    def to_rows(self):
+        return list(self)
+
+    # 转为 字段名 -> 列表 的字典，便于序列化为 JSON
+    def to_columns(self):
+        return {name: list(column) for name, column in zip(self.names, self.columns)}
+
+# 按批读取游标中的结果并组装为列式结果集，不会同时持有全部行
+def fetch_columnar(cursor, batch_size=10000):
+    description = cursor.description or ()
+    names = [field[0] for field in description]
+    typecodes = [ARRAY_TYPECODES.get(field[1]) for field in description]
+    columns = [array(typecode) if typecode else [] for typecode in typecodes]
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+
+        if not rows:
+            break
+
+        for index, values in enumerate(zip(*rows)):
+            column = columns[index]
+
+            if isinstance(column, list):
+                column.extend(values)
+                continue
+
+            # 含有 NULL 或超出 64 位范围的值时，该列改为用列表保存
+            try:
+                column.extend(array(column.typecode, values))
+            except (TypeError, OverflowError):
+                columns[index] = column.tolist() + list(values)
+
+    return ColumnarResult(names, columns)
+
+# 打开游标，执行成功时提交事务，出现异常时回滚，结束后关闭游标
+@contextmanager
+def open_cursor(conn, cursor_class=None):
+    cursor = conn.cursor(cursor_class) if cursor_class is not None else conn.cursor()
+
+    try:
+        yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+# 普通游标类型对应的无缓冲游标类型，无缓冲游标边读取网络数据边返回结果，不会把结果集整个载入内存
+SS_CURSOR_MAP = {
+    pymysql.cursors.Cursor: pymysql.cursors.SSCursor,
+    pymysql.cursors.DictCursor: pymysql.cursors.SSDictCursor
+}
+
+# 为表名、字段名加上反引号，表名可以带上数据库名，例如 shop.user
+def quote_name(name):
+    return '.'.join('`%s`' % part.replace('`', '``') for part in name.split('.'))
+
+# 把参数字典逐个转义后拼接成多行 INSERT 语句，每条语句不超过 batch_size 行与 max_length 个字节，输出 (语句, 行数)
+# max_length 与服务端的 max_allowed_packet 一样按连接编码后的字节数计算
+# columns 为空时以第一行的键作为字段列表，缺少的字段写入 NULL
+def iter_insert_batches(conn, table, rows, columns=None, batch_size=1000, max_length=1000000):
+    encoding = getattr(conn, 'encoding', 'utf8')
+    head = None
+    values = []
+    size = 0
+
+    for row in rows:
+        if head is None:
+            columns = list(columns or row)
+            head = 'INSERT INTO %s (%s) VALUES ' % (quote_name(table), ', '.join(quote_name(column) for column in columns))
+            head_size = len(head.encode(encoding))
+            size = head_size
+
+        value = '(%s)' % ', '.join(conn.escape(row.get(column)) for column in columns)
+
+        # 纯 ASCII 的值字符数即字节数，不需要编码
+        length = len(value) if value.isascii() else len(value.encode(encoding))
+
+        # 行数或语句长度达到上限时输出当前语句
+        if values and (len(values) >= batch_size or size + length + 1 > max_length):
+            yield head + ','.join(values), len(values)
+            values, size = [], head_size
+
+        values.append(value)
+        size += length + 1
+
+    if values:
+        yield head + ','.join(values), len(values)
+
+# 连接级别的错误码：无法连接服务器、服务器已断开、查询过程中连接丢失
+BROKEN_ERRNOS = {2003, 2006, 2013}
+
+# 判断异常是否说明连接已失效，出现时连接不再放回连接池，死锁、锁等待超时与语句错误不影响连接本身
+def is_broken(error):
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+
+    return isinstance(error, pymysql.err.OperationalError) and bool(error.args) and error.args[0] in BROKEN_ERRNOS
+
+# 写操作之后只使用主库的截止时间，请求之外的上下文使用，数据库模块 -> 截止时间
+sticky_state = contextvars.ContextVar('aureus_db_sticky', default=None)
+
+# 数据库连接池
+class ConnectionPool:
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10, max_age=3600, ping_interval=1):
+        self.connect = connect                  # 创建新连接的函数
+        self.min_size = min_size                # 初始化时预先建立的连接数量
+        self.max_size = max_size                # 最多同时打开的连接数量
+        self.timeout = timeout                  # 连接全部被占用时等待空闲连接的秒数
+        self.max_age = max_age                  # 连接最长使用秒数，超过后关闭并重新建立，为 None 时不限制
+        self.ping_interval = ping_interval      # 连接空闲超过该秒数后，取出时先 ping 检查是否仍然可用
+        self.idle = deque()                     # 空闲连接，元素为 (连接, 放回时间)
+        self.waiters = deque()                  # 等待中的线程，按先来后到的顺序直接交给它们归还的连接
+        self.created = {}                       # 连接 -> (建立时间, 所属代数)
+        self.generation = 0                     # 连接代数，重置连接池后旧连接在归还时关闭
+        self.size = 0                           # 已打开（包括正在建立）的连接数量
+        self.checkouts = 0                      # 取出连接的次数
+        self.opened = 0                         # 建立连接的次数
+        self.closed = 0                         # 关闭连接的次数
+        self.timeouts = 0                       # 等待超时的次数
+        self.wait_time = 0.0                    # 等待空闲连接的总秒数
+        self.shutdown = False                   # 连接池是否已关闭
+        self.local = threading.local()          # 线程当前占用的连接，同一线程嵌套取出时复用同一个连接
+        self.pid = os.getpid()                  # 创建连接池的进程，多进程服务器 fork 出的子进程不能使用父进程的连接
+        self.lock = threading.Lock()
+
+        # 预先建立最少数量的连接
+        for _ in range(min_size):
+            with self.lock:
+                self.size += 1
+            self.release_conn(self.open())
+
+    # 把连接或空出的连接数量交给最早等待的线程，没有等待的线程时返回 False，调用前需要先获得锁
+    def hand_over(self, item):
+        if not self.waiters:
+            return False
+
+        waiter = self.waiters.popleft()
+        waiter[1] = item
+        waiter[0].set()
+        return True
+
+    # 释放占用的连接数量，有线程在等待时把数量转交给它，调用前需要先获得锁
+    def free_slot(self):
+        if not self.hand_over(None):
+            self.size -= 1
+
+    # 建立新连接，调用前需要先占用连接数量
+    def open(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            # 建立失败时释放占用的数量
+            with self.lock:
+                self.free_slot()
+            raise
+
+        with self.lock:
+            self.created[conn] = (time.time(), self.generation)
+            self.opened += 1
+
+        return conn
+
+    # 判断连接是否可以继续使用
+    def usable(self, conn, last_used):
+        created, generation = self.created.get(conn, (0, -1))
+
+        # 连接池被重置过，或者连接已超过最长使用时间
+        if generation != self.generation or self.max_age is not None and time.time() - created > self.max_age:
+            return False
+
+        # 连接空闲时间较长时，服务端可能已经断开，先 ping 检查
+        if time.time() - last_used >= self.ping_interval:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                return False
+
+        return True
+
+    # 关闭连接并释放占用的数量
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+        with self.lock:
+            self.created.pop(conn, None)
+            self.closed += 1
+            self.free_slot()
+
+    # 等待其它线程归还连接，返回 (连接, 放回时间)，得到的是空出的连接数量时返回 None
+    def wait(self, start):
+        waiter = [threading.Event(), None]
+
+        with self.lock:
+            self.waiters.append(waiter)
+
+        if not waiter[0].wait(max(start + self.timeout - time.time(), 0)):
+            with self.lock:
+                # 超时的同时可能刚好被交给了连接
+                if not waiter[0].is_set():
+                    self.waiters.remove(waiter)
+                    self.timeouts += 1
+                    self.wait_time += time.time() - start
+                    raise exceptions.PoolTimeoutError()
+
+        # 等待期间连接池被关闭
+        if self.shutdown:
+            if waiter[1] is not None:
+                self.discard(waiter[1][0])
+            else:
+                with self.lock:
+                    self.free_slot()
+            raise exceptions.PoolTimeoutError('Connection pool is closed')
+
+        return waiter[1]
+
+    # 在 fork 出的子进程中第一次使用时丢弃父进程的连接，只丢弃引用不关闭，关闭会断开父进程仍在使用的连接
+    def check_pid(self):
+        if self.pid == os.getpid():
+            return
+
+        self.lock = threading.Lock()
+
+        with self.lock:
+            self.pid = os.getpid()
+            self.idle = deque()
+            self.waiters = deque()
+            self.created = {}
+            self.generation += 1
+            self.size = 0
+            self.local = threading.local()
+
+    # 从连接池中取出一个可用连接，连接全部被占用时阻塞等待
+    def checkout(self):
+        self.check_pid()
+        start = time.time()
+
+        while True:
+            item = None
+            wait = False
+
+            with self.lock:
+                if self.shutdown:
+                    raise exceptions.PoolTimeoutError('Connection pool is closed')
+
+                if self.idle:
+                    # 优先使用最近放回的连接，多余的连接空闲久了会因为超过最长使用时间被回收
+                    item = self.idle.pop()
+                elif self.size < self.max_size:
+                    # 先占用数量，在锁外建立连接
+                    self.size += 1
+                else:
+                    wait = True
+
+            if wait:
+                item = self.wait(start)
+
+            if item is None:
+                conn = self.open()
+            elif not self.usable(*item):
+                # 不可用的连接直接关闭，重新尝试
+                self.discard(item[0])
+                continue
+            else:
+                conn = item[0]
+
+            with self.lock:
+                self.checkouts += 1
+                self.wait_time += time.time() - start
+
+            return conn
+
+    # 把连接放回连接池，有线程在等待时直接交给它
+    def release_conn(self, conn):
+        created, generation = self.created.get(conn, (0, -1))
+
+        if self.shutdown or generation != self.generation:
+            self.discard(conn)
+            return
+
+        with self.lock:
+            item = (conn, time.time())
+
+            if not self.hand_over(item):
+                self.idle.append(item)
+
+    # 取出连接，同一线程已经占用连接时直接复用，保证嵌套调用与事务使用同一个连接
+    def acquire(self):
+        self.check_pid()
+        local = self.local
+
+        if getattr(local, 'conn', None) is not None:
+            local.depth += 1
+            return local.conn
+
+        local.conn = self.checkout()
+        local.depth = 1
+        local.broken = False
+        return local.conn
+
+    # 归还连接，线程最外层的占用结束时才真正放回连接池，broken 为 True 时关闭连接
+    def release(self, conn, broken=False):
+        local = self.local
+        local.broken = local.broken or broken
+        local.depth -= 1
+
+        if local.depth > 0:
+            return
+
+        local.conn = None
+
+        if local.broken:
+            self.discard(conn)
+        else:
+            self.release_conn(conn)
+
+    # 连接上下文，执行过程中连接失效时不再放回连接池
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+
+        try:
+            yield conn
+        except Exception as e:
+            broken = is_broken(e)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    # 重置连接池，关闭全部空闲连接，正在使用的连接归还时关闭
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            idle = list(self.idle)
+            self.idle.clear()
+
+        for conn, _ in idle:
+            self.discard(conn)
+
+    # 关闭连接池
+    def close(self):
+        with self.lock:
+            self.shutdown = True
+
+        self.reset()
+
+    # 连接池统计信息
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': self.size - len(self.idle),
+                'waiting': len(self.waiters),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'opened': self.opened,
+                'closed': self.closed,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time
+            }
+
+# 只读语句的首个关键字，其它语句都视为写操作
+READ_KEYWORDS = {'select', 'show', 'describe', 'desc', 'explain', 'set', 'use', 'begin', 'start', 'commit', 'rollback'}
+
+# 可以发往只读副本的语句的首个关键字
+REPLICA_KEYWORDS = {'select', 'show', 'describe', 'desc', 'explain'}
+
+# 加锁读取的语句必须在主库执行
+lock_comp = re.compile(r'\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b', re.I)
+
+# 判断语句是否可以发往只读副本
+def is_read(sql):
+    words = sql.split(None, 1)
+    return bool(words) and words[0].lower() in REPLICA_KEYWORDS and lock_comp.search(sql) is None
+
+# 表名，可以带反引号与数据库名
+table_pattern = r'(`?[\w$]+`?(?:\.`?[\w$]+`?)?)'
+
+# 查询语句读取的表，包括以逗号分隔、带别名的多个表
+read_comp = re.compile(r'\b(?:from|join)\s+(%s(?:\s+(?:as\s+)?\w+)?(?:\s*,\s*%s(?:\s+(?:as\s+)?\w+)?)*)' % (table_pattern, table_pattern), re.I)
+
+# 单表写操作语句修改的表，UPDATE、DELETE 与 DROP TABLE 另行解析
+write_comp = re.compile(r'^\s*(?:(?:insert|replace)(?:\s+(?:low_priority|delayed|high_priority|ignore))*(?:\s+into)?'
+                        r'|(?:truncate|alter|create)(?:\s+table)?(?:\s+if(?:\s+not)?\s+exists)?)\s+%s' % table_pattern, re.I | re.S)
+
+# 多表 UPDATE 的表引用部分，位于 UPDATE 与 SET 之间，例如 UPDATE a JOIN b ON ... SET
+update_comp = re.compile(r'^\s*update(?:\s+(?:low_priority|ignore))*\s+(.*?)\s+set\b', re.I | re.S)
+
+# 多表 DELETE 的表引用部分，位于 DELETE 与 WHERE 等子句之间，例如 DELETE a, b FROM a JOIN b ON ... WHERE
+delete_comp = re.compile(r'^\s*delete(?:\s+(?:low_priority|quick|ignore))*\s+(.*?)(?:\s+(?:where|order\s+by|limit)\b|\s*;?\s*$)', re.I | re.S)
+
+# DROP TABLE 语句，可以一次删除多个表
+drop_comp = re.compile(r'^\s*drop\s+(?:temporary\s+)?tables?(?:\s+if\s+exists)?\s+(.*?)(?:\s+(?:restrict|cascade))?\s*;?\s*$', re.I | re.S)
+
+# 表引用中的表名，出现在开头、逗号、JOIN、FROM 与 USING 之后
+table_ref_comp = re.compile(r'(?:^|,|\bjoin\b|\bfrom\b|\busing\b)\s*(?!(?:from|using)\b)%s' % table_pattern, re.I)
+
+# 统一表名格式，去掉反引号与数据库名并转为小写
+def normalize_table(name):
+    return name.replace('`', '').split('.')[-1].lower()
+
+# 统一 SQL 语句格式，合并多余的空白
+def normalize_sql(sql):
+    return ' '.join(sql.split())
+
+# 获取查询语句读取的全部表
+def read_tables(sql):
+    tables = set()
+
+    for match in read_comp.finditer(sql):
+        for part in match.group(1).split(','):
+            tables.add(normalize_table(part.split()[0]))
+
+    return tables
+
+# 获取表引用部分中的全部表名，多表语句中的别名也会被当作表名，多失效一些缓存不影响正确性，没有找到表名时返回 None
+def table_refs(refs):
+    tables = {normalize_table(name) for name in table_ref_comp.findall(refs.strip())}
+    return tables or None
+
+# 获取写操作语句修改的表，只读语句返回空集合，无法识别的写操作返回 None
+# 多表 UPDATE、DELETE 与 DROP TABLE 返回涉及的全部表
+def write_tables(sql):
+    words = sql.split(None, 1)
+
+    if not words or words[0].lower() in READ_KEYWORDS:
+        return set()
+
+    keyword = words[0].lower()
+    comp = {'update': update_comp, 'delete': delete_comp, 'drop': drop_comp}.get(keyword)
+
+    # DROP DATABASE、DROP INDEX 等无法确定表的语句返回 None
+    if comp is not None:
+        match = comp.match(sql)
+        return table_refs(match.group(1)) if match is not None else None
+
+    match = write_comp.match(sql)
+    return {normalize_table(match.group(1))} if match else None
+
+# 复制结果集中的每一行，调用方修改返回的行不会影响缓存内容
+def copy_rows(rows):
+    return [dict(row) if isinstance(row, dict) else row for row in rows]
+
+# 查询结果缓存，按 SQL 语句 + 参数缓存查询结果，并以读取的表作为标签，写入这些表时自动失效
+class QueryCache:
+    def __init__(self, max_entries=1024, default_ttl=60):
+        self.max_entries = max_entries      # 最多缓存的结果数量，超出时淘汰最久未使用的结果
+        self.default_ttl = default_ttl      # 默认有效期，单位为秒
+        self.entries = OrderedDict()        # 缓存键 -> (过期时间, 影响行数, 结果集, 表集合)
+        self.tags = {}                      # 表名 -> 读取该表的缓存键集合
+        self.version = 0                    # 每次失效时递增，查询期间发生过失效的结果不写入缓存
+        self.hits = 0                       # 命中次数
+        self.misses = 0                     # 未命中次数
+        self.evictions = 0                  # 淘汰次数
+        self.invalidations = 0              # 因写入而失效的结果数量
+        self.lock = threading.Lock()
+
+    # 生成缓存键，variant 用于区分同一查询的不同结果格式
+    def key(self, sql, params=None, variant=None):
+        return normalize_sql(sql), repr(sorted(params.items())) if isinstance(params, dict) else repr(params), variant
+
+    # 获取缓存的 (影响行数, 结果集)，不存在或已过期时返回 None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], entry[2]
+
+            # 移除过期的结果
+            if entry is not None:
+                self.remove(key)
+
+            self.misses += 1
+            return None
+
+    # 缓存查询结果，version 为查询开始前的失效版本，查询期间有写入时放弃缓存
+    def set(self, key, rows, result, tables, ttl=None, version=None):
+        expires = time.time() + (self.default_ttl if ttl is None else ttl)
+
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (expires, rows, result, tables)
+
+            for table in tables:
+                self.tags.setdefault(table, set()).add(key)
+
+            # 超出容量时淘汰最久未使用的结果
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # 移除缓存项及其标签，调用前需要先获得锁
+    def remove(self, key):
+        for table in self.entries.pop(key)[3]:
+            keys = self.tags.get(table)
+
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[table]
+
+    # 使读取了指定表的结果失效
+    def invalidate(self, *tables):
+        with self.lock:
+            self.version += 1
+
+            for table in tables:
+                for key in list(self.tags.get(normalize_table(table), ())):
+                    self.remove(key)
+                    self.invalidations += 1
+
+    # 清空缓存
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.tags.clear()
+
+    # 根据执行过的写操作语句使缓存失效，无法识别修改的表时清空缓存
+    # 缓存为空时同样需要递增失效版本，写入之前开始的查询不能把旧结果写入缓存
+    def invalidate_sql(self, sql):
+        tables = write_tables(sql)
+
+        if tables is None:
+            self.clear()
+        elif tables:
+            self.invalidate(*tables)
+
+    # 缓存统计信息
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'entries': len(self.entries),
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# 只读副本
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name            # 副本名，格式为 主机名:端口号
+        self.pool = pool            # 副本的连接池
+        self.reads = 0              # 分配到的查询次数
+        self.failures = 0           # 连接失败次数
+        self.ejected = False        # 是否已被剔除，剔除期间不再分配查询
+        self.ejected_until = 0      # 被剔除到该时间为止，之后由后台线程检查副本是否恢复
+        self.probe_lock = threading.Lock()  # 同一时间只有一个线程检查副本
+
+    # 当前占用的连接数量
+    def load(self):
+        return self.pool.size - len(self.pool.idle)
+
+    # 副本统计信息
+    def stats(self):
+        return {
+            'name': self.name,
+            'reads': self.reads,
+            'failures': self.failures,
+            'ejected': self.ejected,
+            'pool': self.pool.stats()
+        }
+
 # 数据库模块
 class BaseDB:
 
     # 实例对象初始化方法
-    def __init__(self, user, password, database='', host='127.0.0.1', port=3306, charset='utf8', cursor_class=pymysql.cursors.DictCursor):
+    # pool 为 True 或连接池参数字典时使用连接池，例如 pool={'max_size': 20, 'timeout': 5}，此时 conn 为 None
+    # query_cache 为查询结果缓存的参数字典，例如 query_cache={'max_entries': 4096}
+    # replicas 为只读副本的连接参数列表，例如 [{'host': '10.0.0.2'}, {'host': '10.0.0.3', 'port': 3307}]，未指定的参数与主库相同
+    # 只读查询按 balance（round_robin 轮询或 least_loaded 最少连接）分配到副本，写操作与存储过程在主库执行
+    # 写操作之后的 sticky_time 秒内，同一请求（上下文）的查询都在主库执行，保证读到自己的写入
+    # 连接失败的副本会被剔除，每隔 eject_time 秒检查一次，能建立连接并 ping 通后才恢复，所有副本都不可用时查询回到主库
+    def __init__(self, user, password, database='', host='127.0.0.1', port=3306, charset='utf8', cursor_class=pymysql.cursors.DictCursor, pool=None, query_cache=None,
+                 replicas=None, balance='round_robin', sticky_time=5, eject_time=30):
         self.user = user                    # 连接用户
         self.password = password            # 连接用户密码
         self.database = database            # 选择的数据库
@@ -66,53 +724,382 @@ class BaseDB:
         self.port = port                    # 端口号，默认 3306
         self.charset = charset              # 数据库编码，默认 UTF-8
         self.cursor_class = cursor_class    # 数据库游标类型，默认为 DictCursor，返回的每一行数据集都是个字典
-        self.conn = self.connect()        # 数据库连接对象
+        self.pool = None                    # 数据库连接池
+        self.conn = None                    # 数据库连接对象，使用连接池时为 None
+        self.query_cache = QueryCache(**(query_cache or {}))   # 查询结果缓存，只缓存 execute 时指定了 cache 参数的查询
 
-    # 建立连接
-    def connect(self):
+        self.balance = balance              # 副本分配方式
+        self.sticky_time = sticky_time      # 写操作之后在主库读取的秒数
+        self.eject_time = eject_time        # 副本连接失败后检查是否恢复的间隔秒数
+        self.counter = count()              # 轮询计数
+
+        pool_options = pool if isinstance(pool, dict) else {}
+
+        if pool:
+            self.pool = ConnectionPool(self.connect, **pool_options)
+        else:
+            self.conn = self.connect()
+
+        # 每个副本使用独立的连接池
+        self.replicas = [self.open_replica('%s:%s' % (options.get('host', host), options.get('port', port)), options, pool_options)
+                         for options in (replicas or ())]
+
+    # 创建副本及其连接池，启动时无法连接的副本不影响应用启动，以剔除状态加入，由后台检查恢复
+    def open_replica(self, name, options, pool_options):
+        connect = partial(self.connect, **options)
+
+        try:
+            return Replica(name, ConnectionPool(connect, **pool_options))
+        except Exception:
+            replica = Replica(name, ConnectionPool(connect, **dict(pool_options, min_size=0)))
+            self.eject(replica)
+            return replica
+
+    # 建立连接，options 中的 host、port、user、password 会覆盖实例的连接参数，用于连接副本
+    def connect(self, **options):
         # 返回一个数据库连接对象
-        return pymysql.connect(host=self.host, user=self.user, port=self.port,
-                            passwd=self.password, db=self.database,
+        return pymysql.connect(host=options.get('host', self.host), user=options.get('user', self.user), port=options.get('port', self.port),
+                            passwd=options.get('password', self.password), db=self.database,
                             charset=self.charset,
                             cursorclass=self.cursor_class)
 
     # 断开连接
     def close(self):
-        # 关闭数据库连接
-        self.conn.close()
+        # 关闭连接池或数据库连接
+        if self.pool is not None:
+            self.pool.close()
+        else:
+            self.conn.close()
+
+        for replica in self.replicas:
+            replica.pool.close()
+
+    # 选出处理只读查询的副本，没有可用副本、写操作之后或者当前线程正占用主库连接（例如事务中）时返回 None
+    def choose_replica(self):
+        if not self.replicas or self.sticky_state().get(self, 0) > time.time():
+            return None
+
+        if self.pool is not None and getattr(self.pool.local, 'conn', None) is not None:
+            return None
+
+        now = time.time()
+        alive = []
+
+        for replica in self.replicas:
+            if not replica.ejected:
+                alive.append(replica)
+            elif replica.ejected_until <= now:
+                self.start_probe(replica)
+
+        if not alive:
+            return None
+
+        if self.balance == 'least_loaded':
+            return min(alive, key=lambda replica: replica.load())
+
+        return alive[next(self.counter) % len(alive)]
+
+    # 剔除连接失败的副本
+    def eject(self, replica):
+        replica.failures += 1
+        replica.ejected = True
+        replica.ejected_until = time.time() + self.eject_time
+
+        # 关闭副本的空闲连接，恢复后重新建立
+        replica.pool.reset()
+
+    # 在后台线程中检查被剔除的副本，不阻塞发起查询的请求
+    def start_probe(self, replica):
+        if not replica.probe_lock.acquire(False):
+            return
+
+        thread = threading.Thread(target=self.probe, args=(replica,), name='aureus-db-probe')
+        thread.daemon = True
+        thread.start()
+
+    # 建立新连接并 ping 检查副本，成功时恢复分配查询，失败时等待下一次检查
+    def probe(self, replica):
+        try:
+            conn = replica.pool.checkout()
+
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                replica.pool.discard(conn)
+                raise
+
+            replica.pool.release_conn(conn)
+            replica.ejected = False
+        except Exception:
+            replica.failures += 1
+            replica.ejected_until = time.time() + self.eject_time
+        finally:
+            replica.probe_lock.release()
+
+    # 当前上下文的主库读取截止时间，存放在可变的字典中，复制出的上下文（例如 AsyncDB 的线程池调用）中的写操作对发起调用的上下文同样可见
+    # 请求之内使用请求的查询统计，每个请求重新开始；请求之外第一次调用时在当前上下文中创建
+    def sticky_state(self):
+        scope = current_scope.get()
+        if scope is not None:
+            return scope.sticky
+
+        state = sticky_state.get()
+        if state is None:
+            state = {}
+            sticky_state.set(state)
+
+        return state
+
+    # 标记发生了写操作，之后一段时间内当前上下文的查询都在主库执行
+    def mark_write(self):
+        if self.replicas:
+            self.sticky_state()[self] = time.time() + self.sticky_time
+
+    # 从副本取出连接，失败时返回 None，连接失败的副本会被剔除，所有连接都被占用时不剔除
+    def replica_checkout(self, replica, acquire):
+        try:
+            conn = acquire()
+        except exceptions.PoolTimeoutError:
+            return None
+        except Exception:
+            self.eject(replica)
+            return None
+
+        replica.reads += 1
+        return conn
+
+    # 获取数据库连接上下文，使用连接池时从连接池中取出，同一线程内嵌套获取得到同一个连接
+    # read 为 True 时优先使用只读副本，没有可用副本时使用主库
+    @contextmanager
+    def connection(self, read=False):
+        replica = self.choose_replica() if read else None
+        conn = self.replica_checkout(replica, replica.pool.acquire) if replica is not None else None
+
+        # 使用主库
+        if conn is None:
+            if self.pool is None:
+                yield self.conn
+            else:
+                with self.pool.connection() as conn:
+                    yield conn
+            return
+
+        broken = False
+
+        try:
+            yield conn
+        except Exception as e:
+            # 副本连接失效时剔除副本
+            broken = is_broken(e)
+            if broken:
+                self.eject(replica)
+            raise
+        finally:
+            replica.pool.release(conn, broken)
+
+    # 取出一个独占连接，返回 (连接池, 连接)，未使用连接池时连接池为 None
+    def checkout(self, read=False):
+        replica = self.choose_replica() if read else None
+
+        if replica is not None:
+            conn = self.replica_checkout(replica, replica.pool.checkout)
+
+            if conn is not None:
+                return replica.pool, conn
+
+        if self.pool is None:
+            return None, self.conn
+
+        return self.pool, self.pool.checkout()
+
+    # 连接池统计信息，未使用连接池时返回 None
+    def pool_stats(self):
+        return self.pool.stats() if self.pool is not None else None
+
+    # 只读副本统计信息
+    def replica_stats(self):
+        return [replica.stats() for replica in self.replicas]
+
+    # 查询结果缓存统计信息
+    def cache_stats(self):
+        return self.query_cache.stats()
 
     # 数据操作，增，删，改，查
+    # cache 为 True 或有效期秒数时，查询结果会被缓存，写入相关的表时自动失效，例如 execute('SELECT * FROM category', cache=300)
+    # columnar 为 True 时返回列式结果集 ColumnarResult，大结果集占用的内存远小于字典列表
     @DBResult.handler
-    def execute(self, sql, params=None):
-        # 获取数据库连接对象上下文
-        with self.conn as cursor:
-            # 如果参数不为空并且时 Dict 类型时，把 SQL 语句与参数一起传入 execute 中调用，反之直接调用 exevute
+    def execute(self, sql, params=None, cache=None, columnar=False):
+        key = version = None
+
+        # 只读查询优先发往副本，其它语句在主库执行
+        read = is_read(sql)
+        if not read:
+            self.mark_write()
+
+        # 只有只读查询才使用缓存，优先从查询结果缓存中获取，返回逐行复制的结果集，避免调用方修改缓存内容，列式结果集直接共用
+        if cache and read:
+            key = self.query_cache.key(sql, params, columnar)
+            ret = self.query_cache.get(key)
+
+            if ret is not None:
+                return ret[0], ret[1] if columnar else copy_rows(ret[1])
+
+            version = self.query_cache.version
+
+        # 列式结果集使用无缓冲的元组游标，边读取边组装，不生成逐行的字典
+        cursor_class = pymysql.cursors.SSCursor if columnar else None
+
+        # 获取数据库连接与游标上下文
+        with self.connection(read) as conn, open_cursor(conn, cursor_class) as cursor:
+            start = time.time()
+
+            # 如果参数不为空并且时 Dict 类型时，把 SQL 语句与参数一起传入 execute 中调用，反之直接调用 exevute
 
             # 执行语句并获取影响条目数量
             rows = cursor.execute(sql, params) if params and isinstance(params, dict) else cursor.execute(sql)
 
-            # 获取执行结果
-            result = cursor.fetchall()
+            # 获取执行结果，无缓冲游标的影响行数在读完结果后才能确定
+            if columnar:
+                result = fetch_columnar(cursor)
+                if cursor.description:
+                    rows = len(result)
+            else:
+                result = cursor.fetchall()
+
+        # 记录查询耗时
+        profiler.record(sql, time.time() - start, rows)
+
+        if key is not None:
+            self.query_cache.set(key, rows, result if columnar else tuple(result), read_tables(sql), None if cache is True else cache, version)
+            return rows, result if columnar else copy_rows(result)
+
+        # 写操作提交之后使相关的缓存失效
+        self.query_cache.invalidate_sql(sql)
 
         # 返回影响条目数量和执行结果
         return rows, result
 
     # 插入数据并获取最新插入的数据标识，也就是主键索引 ID 字段
+    @DBResult.handler
     def insert(self, sql, params=None):
-        # 获取 SQL 语句执行之后的 DBResult 对象
-        ret = self.execute(sql, params)
+        self.mark_write()
+
+        # 插入与获取 ID 必须使用同一个连接
+        with self.connection() as conn:
+            with open_cursor(conn) as cursor:
+                start = time.time()
+                rows = cursor.execute(sql, params) if params and isinstance(params, dict) else cursor.execute(sql)
+
+            profiler.record(sql, time.time() - start, rows)
+            self.query_cache.invalidate_sql(sql)
+
+            # 返回影响条目数量和插入数据的 ID
+            return rows, conn.insert_id()
+
+    # 批量插入，rows 为参数字典的可迭代对象，拆分为多条多行 INSERT 语句在同一个事务中执行，出错时回滚未提交的部分
+    # commit_every 为每次提交包含的语句数量，为 None 时全部写入后才提交
+    # 返回的 DBResult 中 rows 为影响行数，result 为生成的 ID 范围 (第一个 ID, 最后一个 ID)，表没有自增字段时为 None
+    @DBResult.handler
+    def insert_many(self, table, rows, columns=None, batch_size=1000, max_length=1000000, commit_every=None):
+        total = 0
+        first_id = last_id = None
+        key = None
+
+        self.mark_write()
+
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                for index, (sql, batch_rows) in enumerate(iter_insert_batches(conn, table, rows, columns, batch_size, max_length), 1):
+                    start = time.time()
+                    total += cursor.execute(sql)
+
+                    # 同一次批量插入的语句只有行数不同，只需计算一次指纹，不对整条长语句计算
+                    if key is None:
+                        key = fingerprint(sql[:sql.index(' VALUES ')]) + ' values (?+)'
+                    profiler.record(sql, time.time() - start, batch_rows, key)
+
+                    # 多行 INSERT 语句生成的 ID 是连续的，insert_id 为其中第一行的 ID
+                    insert_id = conn.insert_id()
+                    if insert_id:
+                        if first_id is None:
+                            first_id = insert_id
+                        last_id = insert_id + batch_rows - 1
+
+                    if commit_every and index % commit_every == 0:
+                        conn.commit()
+
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+                self.query_cache.invalidate(table)
+
+        return total, ((first_id, last_id) if first_id is not None else None)
+
+    # 流式查询，返回逐行输出结果的生成器，batches 为 True 时每次输出 batch_size 行组成的列表
+    # 迭代期间独占一个连接；未使用连接池时，迭代结束前不能在同一个连接上执行其它语句
+    def stream(self, sql, params=None, batch_size=1000, batches=False):
+        # 使用连接池时单独取出一个连接，不与当前线程其它查询共用，只读查询优先使用副本
+        pool, conn = self.checkout(is_read(sql))
+        cursor = conn.cursor(SS_CURSOR_MAP.get(self.cursor_class, self.cursor_class))
+        done = False
+        start = time.time()
+        total = 0
+
+        try:
+            cursor.execute(sql, params) if params and isinstance(params, dict) else cursor.execute(sql)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                total += len(rows)
+
+                if batches:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+
+            conn.commit()
+            done = True
+
+            # 记录从执行到读完全部结果的耗时，包括调用方处理结果的时间
+            profiler.record(sql, time.time() - start, total)
+        finally:
+            self.close_stream(pool, conn, cursor, done)
+
+    # 结束流式查询，未读完的结果需要读完才能继续使用连接，使用连接池时直接关闭连接代价更小
+    def close_stream(self, pool, conn, cursor, done):
+        if pool is None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+            return
 
-        # 为 DBResult 对象的 result 属性重新赋值为插入数据的 ID
-        ret.result = self.conn.insert_id()
+        if not done:
+            pool.discard(conn)
+            return
 
-        # 返回 DBResult 对象
-        return ret
+        cursor.close()
+        pool.release_conn(conn)
 
     # 存储过程调用
     @DBResult.handler
     def process(self, func, params=None):
-        # 获取数据库连接对象上下文
-        with self.conn as cursor:
+        # 存储过程可能修改数据，在主库执行
+        self.mark_write()
+
+        # 获取数据库连接与游标上下文
+        with self.connection() as conn, open_cursor(conn) as cursor:
+            start = time.time()
 
             # 如果参数不为空并且时 Dict 类型时，把存储过程名与参数一起传入 callproc 中调用，反之直接调用 callproc
             rows = cursor.callproc(func, params) if params and isinstance(params, dict) else cursor.callproc(func)
@@ -120,6 +1107,11 @@ class BaseDB:
             # 获取存储过程执行结果
             result = cursor.fetchall()
 
+        profiler.record('CALL %s' % func, time.time() - start, len(result))
+
+        # 无法得知存储过程修改了哪些表，清空查询结果缓存
+        self.query_cache.clear()
+
         return rows, result
 
     # 创建数据库
@@ -134,9 +1126,115 @@ class BaseDB:
      # 选择数据库
     @DBResult.handler
     def choose_db(self, db_name):
+        self.database = db_name
+        self.query_cache.clear()
+
+        for replica in self.replicas:
+            replica.pool.reset()
+
+        # 使用连接池时重置连接池，之后建立的连接都会选择新的数据库
+        if self.pool is not None:
+            self.pool.reset()
+            return None, None
+
         # 调用 PyMySQL 的 select_db 方法选择数据库
         self.conn.select_db(db_name)
 
         # 因为正确执行的话没有影响条数和执行结果，所以返回两个空值 None
         return None, None
 
+
+# 异步数据库模块，在专用的有界线程池中执行 BaseDB 的阻塞调用，不阻塞事件循环
+# 线程数默认为主库与副本连接池的最大连接数之和，大量协程共用少量连接；未使用连接池时只用一个线程串行执行
+class AsyncDB:
+    def __init__(self, db, max_workers=None, timeout=None):
+        self.db = db                # 同步的数据库模块
+        self.timeout = timeout      # 默认超时秒数，为 None 时不限制
+
+        if max_workers is None:
+            max_workers = (db.pool.max_size if db.pool is not None else 1) + sum(replica.pool.max_size for replica in db.replicas)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='aureus-db')
+
+    # 在线程池中执行函数，携带当前上下文，使查询统计归入发起调用的请求
+    # 取消或超时时，尚未开始执行的调用不再执行，已经开始的调用会在后台执行完毕
+    async def run(self, func, *args, timeout=None, **options):
+        loop = asyncio.get_running_loop()
+
+        # 复制上下文之前先准备好主库读取截止时间的字典，线程池中的写操作才能影响之后的查询
+        self.db.sticky_state()
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self.executor, partial(context.run, func, *args, **options))
+
+        timeout = self.timeout if timeout is None else timeout
+        if timeout is None:
+            return await future
+
+        return await asyncio.wait_for(future, timeout)
+
+    # 执行阻塞调用，超时与 BaseDB 的其它异常一样放进 DBResult 的 error 中
+    async def call(self, func, *args, timeout=None, **options):
+        try:
+            return await self.run(func, *args, timeout=timeout, **options)
+        except asyncio.TimeoutError as e:
+            ret = DBResult()
+            ret.error = e
+            return ret
+
+    # 数据操作，参数与 BaseDB.execute 相同
+    async def execute(self, sql, params=None, cache=None, columnar=False, timeout=None):
+        return await self.call(self.db.execute, sql, params, cache, columnar, timeout=timeout)
+
+    # 插入数据并获取插入数据的 ID
+    async def insert(self, sql, params=None, timeout=None):
+        return await self.call(self.db.insert, sql, params, timeout=timeout)
+
+    # 批量插入，rows 会在线程池中被迭代，不应是依赖事件循环的对象
+    async def insert_many(self, table, rows, timeout=None, **options):
+        return await self.call(self.db.insert_many, table, rows, timeout=timeout, **options)
+
+    # 存储过程调用
+    async def process(self, func, params=None, timeout=None):
+        return await self.call(self.db.process, func, params, timeout=timeout)
+
+    # 流式查询，返回异步生成器，每次在线程池中读取一批结果
+    async def stream(self, sql, params=None, batch_size=1000, batches=False, timeout=None):
+        rows = self.db.stream(sql, params, batch_size, batches=True)
+
+        # 读取与关闭共用一把锁，读取超时或被取消后线程池中的读取仍在执行，关闭必须排在它之后
+        lock = threading.Lock()
+        fetching = False
+
+        def fetch():
+            with lock:
+                return next(rows, None)
+
+        def close():
+            with lock:
+                rows.close()
+
+        try:
+            while True:
+                fetching = True
+                batch = await self.run(fetch, timeout=timeout)
+                fetching = False
+
+                if batch is None:
+                    break
+
+                if batches:
+                    yield batch
+                else:
+                    for row in batch:
+                        yield row
+        finally:
+            # 提前结束时关闭同步生成器，释放占用的连接；还有读取在执行时不等待它，由线程池在读取结束后关闭
+            if fetching:
+                self.executor.submit(close)
+            else:
+                await self.run(close)
+
+    # 关闭数据库连接与线程池
+    async def close(self):
+        await self.run(self.db.close)
+        self.executor.shutdown(wait=False)
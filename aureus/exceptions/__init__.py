@@ -9,6 +9,7 @@ ERROR_MAP = {
     '13': Response('<h1>E13 No Read Permission</h1>', content_type=content_type, status=500),
     '401': Response('<h1>401 Unknown Or Unsupported Method</h1>', content_type=content_type, status=401),
     '404': Response('<h1>404 Source Not Found<h1>', content_type=content_type, status=404),
+    '413': Response('<h1>413 Session Too Large</h1>', content_type=content_type, status=413),
     '503': Response('<h1>503 Unknown Function Type</h1>', content_type=content_type, status=503)
 }
 
@@ -64,6 +65,48 @@ class UnknownFuncError(AUREUSException):
         super(UnknownFuncError, self).__init__(code, message)
 
 
+# 模版语法错误
+class TemplateSyntaxError(AUREUSException):
+    def __init__(self, message='Template syntax error'):
+        super(TemplateSyntaxError, self).__init__(message=message)
+
+
+# 会话超出 Cookie 大小限制
+class SessionTooLargeError(AUREUSException):
+    def __init__(self, code='413', message='Session too large for cookie'):
+        super(SessionTooLargeError, self).__init__(code, message)
+
+
+# 等待数据库连接池中的空闲连接超时
+class PoolTimeoutError(AUREUSException):
+    def __init__(self, message='Timed out waiting for a database connection'):
+        super(PoolTimeoutError, self).__init__(message=message)
+
+
+# 框架异常被捕获时调用的函数，参数为异常，例如指标模块用它按异常编号统计错误
+error_hooks = []
+
+# 把框架异常转换为对应的响应体
+def error_response(e):
+    for hook in error_hooks:
+        hook(e)
+
+    # 判断下异常的编号，如果不为空且关联再 ERROR_MAP 中，进行对应的处理，反之接着抛出
+    if e.code in ERROR_MAP and ERROR_MAP[e.code]:
+
+        # 获取异常关联的结果
+        rep = ERROR_MAP[e.code]
+
+        # 如果异常编号小于 100，响应状态码统一设置为 500 服务端错误
+        status = int(e.code) if int(e.code) >= 100 else 500
+
+        # 判断结果是否一个响应体，如果不是，则应该就是自定义异常处理函数，调用它并封装为响应体返回
+        return rep if isinstance(rep, Response) or rep is None else Response(rep(), content_type=content_type, status=status)
+
+    # 接着抛出没有对应处理的异常
+    raise e
+
+
 # 异常捕获
 def capture(f):
     def decorator(*args, **options):
@@ -72,25 +115,23 @@ def capture(f):
             # 尝试执行函数
             rep = f(*args, **options)
         except AUREUSException as e:
-            # 当捕获到 AUREUSException 这个分类的异常时，判断下异常的编号，如果不为空且关联再 ERROR_MAP 中，进行对应的处理，反之接着抛出
-            if e.code in ERROR_MAP and ERROR_MAP[e.code]:
-
-                # 获取异常关联的结果
-                rep = ERROR_MAP[e.code]
-
-                # 如果异常编号小于 100，响应状态码统一设置为 500 服务端错误
-                status = int(e.code) if int(e.code) >= 100 else 500
-
-                # 判断结果是否一个响应体，如果不是，则应该就是自定义异常处理函数，调用它并封装为响应体返回
-                return rep if isinstance(rep, Response) or rep is None else Response(rep(), content_type=content_type, status=status)
-            else:
-                # 接着抛出没有对应处理的异常
-                raise e
+            # 当捕获到 AUREUSException 这个分类的异常时，转换为对应的响应体
+            return error_response(e)
         # 返回函数执行正常的结果
         return rep
     # 返回装饰器
     return decorator
 
+
+# 异步函数的异常捕获
+def capture_async(f):
+    async def decorator(*args, **options):
+        try:
+            return await f(*args, **options)
+        except AUREUSException as e:
+            return error_response(e)
+    return decorator
+
     
 # 异常处理重载装饰器，参数为异常编号，需要注意的是这里的编号为了方便开发者所以用的是整形
 def reload(code):
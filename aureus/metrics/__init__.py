@@ -0,0 +1,551 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+import aureus.exceptions as exceptions
+
+
+# 请求耗时直方图的分桶上限，单位为秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 响应大小直方图的分桶上限，单位为字节
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# 统计时使用的请求方法，其它请求方法归为 OTHER，避免标签数量无限增长
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+# 没有匹配到节点的请求（404 等）的节点名
+UNMATCHED = 'unmatched'
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 当前请求的指标记录
+current_request = ContextVar('aureus_request_metrics', default=None)
+
+# 单个请求的指标记录
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()    # 开始时间
+        self.error = None                   # 转换为响应体的框架异常编号
+        self.token = None                   # 恢复上下文用的令牌
+        self.done = False                   # 是否已经记录
+
+# 请求的节点名
+def endpoint_of(request):
+    return getattr(request, 'endpoint', None) or UNMATCHED
+
+# 格式化数值
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+
+    return repr(value)
+
+# 转义标签值
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+# 格式化标签，例如 {endpoint="index",method="GET"}
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+# 把直方图转换为指标样本，分桶为非累计计数，输出时再累计
+def histogram_samples(samples, name, buckets, values):
+    for endpoint, counts in values.items():
+        for le, count in zip(buckets + (float('inf'),), counts):
+            if count:
+                key = (name + '_bucket', (('endpoint', endpoint), ('le', format_value(le))))
+                samples[key] = samples.get(key, 0) + count
+
+        key = (name + '_sum', (('endpoint', endpoint),))
+        samples[key] = samples.get(key, 0) + counts[-2]
+        key = (name + '_count', (('endpoint', endpoint),))
+        samples[key] = samples.get(key, 0) + counts[-1]
+
+# 读取注册函数的值，返回 {标签: 值}
+def read_func(labels, func):
+    value = func()
+
+    if isinstance(value, dict):
+        return {tuple(zip(labels, key if isinstance(key, tuple) else (key,))): v for key, v in value.items()}
+
+    return {(): value}
+
+# 多进程共享的指标存储，每个进程定期把计数增量累加到同一个 SQLite 数据库中，
+# 瞬时值按进程分别保存，汇总时只统计仍在更新的进程
+class MetricsStore:
+    def __init__(self, path, interval=1.0, timeout=5.0):
+        self.path = path                    # 数据库文件路径
+        self.interval = interval            # 写入间隔秒数
+        self.timeout = timeout              # 等待其它进程释放写锁的超时时间
+        self.local = threading.local()      # SQLite 连接不能跨线程使用，每个线程单独持有一个连接
+
+        conn = self.connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sample '
+                         '(name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels))')
+            conn.execute('CREATE TABLE IF NOT EXISTS gauge '
+                         '(pid INTEGER NOT NULL, name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, updated REAL NOT NULL, '
+                         'PRIMARY KEY (pid, name, labels))')
+
+        # SQLite 连接不能跨进程使用，fork 出的子进程重新建立连接
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        self.local = threading.local()
+
+    # 获取当前线程的数据库连接
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+
+        return conn
+
+    # 进程的瞬时值超过该秒数没有更新时视为进程已退出
+    def stale_after(self):
+        return max(self.interval * 5, 5.0)
+
+    # 写入计数增量与本进程的瞬时值
+    def write(self, samples, gauges):
+        pid = os.getpid()
+        now = time.time()
+
+        with self.connect() as conn:
+            conn.executemany('INSERT INTO sample (name, labels, value) VALUES (?, ?, ?) '
+                             'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                             [(name, json.dumps(labels), value) for (name, labels), value in samples.items()])
+            conn.execute('DELETE FROM gauge WHERE pid = ?', (pid,))
+            conn.executemany('INSERT INTO gauge (pid, name, labels, value, updated) VALUES (?, ?, ?, ?, ?)',
+                             [(pid, name, json.dumps(labels), value, now) for (name, labels), value in gauges.items()])
+
+    # 读取全部进程汇总后的计数与瞬时值，同时清理已退出进程的瞬时值
+    def read(self):
+        deadline = time.time() - self.stale_after()
+
+        with self.connect() as conn:
+            conn.execute('DELETE FROM gauge WHERE updated < ?', (deadline,))
+            samples = {(name, tuple(map(tuple, json.loads(labels)))): value
+                       for name, labels, value in conn.execute('SELECT name, labels, value FROM sample')}
+            gauges = {(name, tuple(map(tuple, json.loads(labels)))): value
+                      for name, labels, value in conn.execute('SELECT name, labels, SUM(value) FROM gauge GROUP BY name, labels')}
+
+        return samples, gauges
+
+    # 删除本进程的瞬时值，进程正常退出时调用
+    def remove(self):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM gauge WHERE pid = ?', (os.getpid(),))
+
+    # 清空全部指标
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM sample')
+            conn.execute('DELETE FROM gauge')
+
+
+# 指标注册表，按节点记录请求数、耗时与响应大小的直方图、框架异常数量，并汇总注册的瞬时值，
+# 输出 Prometheus 文本格式，设置存储后可以汇总多个工作进程的指标
+class MetricsRegistry:
+    def __init__(self, latency_buckets=LATENCY_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.enabled = False                        # 是否开启记录，设置了 metrics_url 时自动开启，未开启时请求不做任何记录
+        self.latency_buckets = latency_buckets      # 耗时直方图的分桶上限
+        self.size_buckets = size_buckets            # 响应大小直方图的分桶上限
+        self.requests = {}                          # (节点名, 请求方法, 状态码) -> 请求数
+        self.errors = {}                            # (节点名, 异常编号) -> 异常数
+        self.latency = {}                           # 节点名 -> [各分桶计数..., 总耗时, 请求数]
+        self.sizes = {}                             # 节点名 -> [各分桶计数..., 总字节数, 响应数]
+        self.active = set()                         # 正在处理的请求，集合的增删在 CPython 中是原子操作，不需要加锁
+        self.funcs = {}                             # 指标名 -> (类型, 说明, 标签名, 取值函数)
+        self.last = {}                              # 计数函数上次写入存储时的值，用于计算增量
+        self.store = None                           # 多进程共享的指标存储
+        self.thread = None                          # 定期写入存储的后台线程
+        self.running = False                        # 是否定期写入存储
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    # 开始记录一个请求
+    def begin(self):
+        if not self.enabled:
+            return None
+
+        scope = RequestMetrics()
+        scope.token = current_request.set(scope)
+        self.active.add(scope)
+        return scope
+
+    # 记录转换为响应体的框架异常，由 exceptions.error_response 调用
+    def record_error(self, e):
+        scope = current_request.get()
+
+        if scope is not None:
+            scope.error = e.code or e.__class__.__name__
+
+    # 记录请求的状态码、耗时与响应大小，headers 中没有 Content-Length 时返回 True，调用方需要用 count_body 统计响应大小
+    def record(self, scope, endpoint, method, status, headers=()):
+        if scope is None or scope.done:
+            return False
+
+        scope.done = True
+        duration = time.perf_counter() - scope.start
+
+        try:
+            current_request.reset(scope.token)
+        except ValueError:
+            pass
+
+        size = None
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    size = int(value)
+                except ValueError:
+                    pass
+
+        if method not in METHODS:
+            method = 'OTHER'
+
+        self.active.discard(scope)
+
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            if scope.error is not None:
+                key = (endpoint, scope.error)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+            self.observe(self.latency, self.latency_buckets, endpoint, duration)
+
+            if size is not None:
+                self.observe(self.sizes, self.size_buckets, endpoint, size)
+
+        return size is None and status not in (204, 304)
+
+    # 记录直方图的一个观测值，调用前需要先获得锁
+    def observe(self, histogram, buckets, endpoint, value):
+        counts = histogram.get(endpoint)
+
+        if counts is None:
+            counts = histogram[endpoint] = [0] * (len(buckets) + 3)
+
+        counts[bisect_left(buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    # 记录流式响应发送完后的大小
+    def observe_size(self, endpoint, size):
+        with self.lock:
+            self.observe(self.sizes, self.size_buckets, endpoint, size)
+
+    # 包装没有 Content-Length 的响应内容，发送完后记录响应大小
+    def count_body(self, iterable, endpoint):
+        return BodyCounter(self, iterable, endpoint)
+
+    # 注册由函数提供的指标，kind 为 gauge（瞬时值）或 counter（只增不减的计数），
+    # 函数返回数值，或者 {标签值: 数值}，此时 labels 为标签名，例如 register('x', 'help', f, labels=('pool',))
+    def register(self, name, help, func, kind='gauge', labels=()):
+        self.funcs[name] = (kind, help, tuple(labels), func)
+
+    # 注销由函数提供的指标
+    def unregister(self, name):
+        self.funcs.pop(name, None)
+        self.last = {key: value for key, value in self.last.items() if key[0] != name}
+
+    # 注册数据库连接池的指标，主库与只读副本的连接池分别以 pool 标签区分
+    def register_db(self, db, name='default'):
+        def pools():
+            items = []
+
+            if db.pool is not None:
+                items.append((name, db.pool))
+
+            for replica in db.replicas:
+                items.append(('%s:%s' % (name, replica.name), replica.pool))
+
+            return [(pool_name, pool.stats()) for pool_name, pool in items]
+
+        def stat(key):
+            return lambda: {pool_name: stats[key] for pool_name, stats in pools()}
+
+        for key, kind, help in (('size', 'gauge', 'Open database connections'),
+                                ('in_use', 'gauge', 'Database connections in use'),
+                                ('idle', 'gauge', 'Idle database connections'),
+                                ('waiting', 'gauge', 'Threads waiting for a database connection'),
+                                ('checkouts', 'counter', 'Database connection checkouts'),
+                                ('timeouts', 'counter', 'Timeouts waiting for a database connection'),
+                                ('wait_time', 'counter', 'Seconds spent waiting for a database connection')):
+            metric = 'aureus_db_pool_%s' % key
+            if kind == 'counter':
+                metric += '_seconds_total' if key == 'wait_time' else '_total'
+
+            self.register(metric, help, stat(key), kind, ('pool',))
+
+    # 读取注册函数的值，返回 (计数, 瞬时值)，delta 为 True 时计数为上次调用以来的增量
+    def read_funcs(self, delta):
+        counters = {}
+        gauges = {}
+
+        for name, (kind, help, labels, func) in list(self.funcs.items()):
+            try:
+                values = read_func(labels, func)
+            except Exception:
+                continue
+
+            for label_values, value in values.items():
+                key = (name, label_values)
+
+                if kind == 'gauge':
+                    gauges[key] = value
+                elif delta:
+                    last = self.last.get(key, 0)
+                    # 计数变小说明被重置过
+                    counters[key] = value - last if value >= last else value
+                    self.last[key] = value
+                else:
+                    counters[key] = value
+
+        gauges[('aureus_requests_in_progress', ())] = len(self.active)
+        return counters, gauges
+
+    # 取出当前进程的计数，返回 (请求数, 异常数, 耗时直方图, 大小直方图)，reset 为 True 时取出后清零
+    def snapshot(self, reset=False):
+        with self.lock:
+            requests, errors, latency, sizes = self.requests, self.errors, self.latency, self.sizes
+
+            if reset:
+                self.requests, self.errors, self.latency, self.sizes = {}, {}, {}, {}
+                return requests, errors, latency, sizes
+
+            return (dict(requests), dict(errors),
+                    {endpoint: list(counts) for endpoint, counts in latency.items()},
+                    {endpoint: list(counts) for endpoint, counts in sizes.items()})
+
+    # 当前进程的计数样本，snapshot 为空时读取当前的计数
+    def samples(self, snapshot=None):
+        requests, errors, latency, sizes = snapshot or self.snapshot()
+        samples = {}
+
+        for (endpoint, method, status), count in requests.items():
+            samples[('aureus_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status))))] = count
+
+        for (endpoint, code), count in errors.items():
+            samples[('aureus_errors_total', (('endpoint', endpoint), ('code', str(code))))] = count
+
+        histogram_samples(samples, 'aureus_request_duration_seconds', self.latency_buckets, latency)
+        histogram_samples(samples, 'aureus_response_size_bytes', self.size_buckets, sizes)
+        return samples
+
+    # 把当前进程的计数增量与瞬时值写入存储
+    def flush(self):
+        store = self.store
+
+        if store is None:
+            return
+
+        with self.flush_lock:
+            snapshot = self.snapshot(reset=True)
+            samples = self.samples(snapshot)
+            counters, gauges = self.read_funcs(delta=True)
+            samples.update(counters)
+
+            try:
+                store.write(samples, gauges)
+            except sqlite3.Error:
+                # 写入失败时把计数放回，下次再写
+                self.restore(snapshot, counters)
+                raise
+
+    # 写入失败时把取出的请求数、异常数与两个直方图全部放回，注册函数的增量退回到上次写入时的值
+    def restore(self, snapshot, counters):
+        requests, errors, latency, sizes = snapshot
+
+        with self.lock:
+            for key, count in requests.items():
+                self.requests[key] = self.requests.get(key, 0) + count
+
+            for key, count in errors.items():
+                self.errors[key] = self.errors.get(key, 0) + count
+
+            for histogram, values in ((self.latency, latency), (self.sizes, sizes)):
+                for endpoint, counts in values.items():
+                    current = histogram.get(endpoint)
+                    histogram[endpoint] = counts if current is None else [a + b for a, b in zip(current, counts)]
+
+        for key, delta in counters.items():
+            if key in self.last:
+                self.last[key] -= delta
+
+    # 汇总全部指标，返回 (计数, 瞬时值)
+    def collect(self):
+        if self.store is not None:
+            self.flush()
+            return self.store.read()
+
+        samples = self.samples()
+        counters, gauges = self.read_funcs(delta=False)
+        samples.update(counters)
+        return samples, gauges
+
+    # 指标族列表，元素为 (指标名, 类型, 说明)
+    def families(self):
+        families = [
+            ('aureus_requests_total', 'counter', 'Requests by endpoint, method and status'),
+            ('aureus_request_duration_seconds', 'histogram', 'Time spent handling requests, until the response starts'),
+            ('aureus_response_size_bytes', 'histogram', 'Response body sizes'),
+            ('aureus_errors_total', 'counter', 'AUREUSException errors by endpoint and code'),
+            ('aureus_requests_in_progress', 'gauge', 'Requests currently being handled')
+        ]
+
+        for name, (kind, help, labels, func) in sorted(self.funcs.items()):
+            families.append((name, kind, help))
+
+        return families
+
+    # 输出 Prometheus 文本格式
+    def render(self):
+        samples, gauges = self.collect()
+        samples.update(gauges)
+        lines = []
+
+        for name, kind, help in self.families():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            if kind != 'histogram':
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == name:
+                        lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+                continue
+
+            # 直方图的分桶按上限排序并累计
+            buckets = {}
+            for (sample_name, labels), value in samples.items():
+                if sample_name == name + '_bucket':
+                    base = tuple(label for label in labels if label[0] != 'le')
+                    buckets.setdefault(base, []).append((float(dict(labels)['le']), value))
+
+            for base in sorted(set(buckets) | {labels for (sample_name, labels) in samples if sample_name == name + '_count'}):
+                total = 0
+                counts = dict(buckets.get(base, ()))
+
+                for le in self.histogram_buckets(name) + (float('inf'),):
+                    total += counts.get(float(le), 0)
+                    lines.append('%s_bucket%s %s' % (name, format_labels(base + (('le', format_value(le)),)), format_value(total)))
+
+                lines.append('%s_sum%s %s' % (name, format_labels(base), format_value(samples.get((name + '_sum', base), 0))))
+                lines.append('%s_count%s %s' % (name, format_labels(base), format_value(samples.get((name + '_count', base), 0))))
+
+        return '\n'.join(lines) + '\n'
+
+    # 直方图的分桶上限
+    def histogram_buckets(self, name):
+        return self.latency_buckets if name == 'aureus_request_duration_seconds' else self.size_buckets
+
+    # 使用多进程共享的存储，每个进程每隔 interval 秒写入一次，reset 为 True 时清空原有指标
+    # start 为 False 时当前进程不写入，只在 fork 出的子进程中写入，多进程服务器的主进程不处理请求
+    def use_store(self, path, interval=1.0, reset=False, start=True):
+        self.stop()
+        self.store = MetricsStore(path, interval)
+        self.running = True
+
+        if reset:
+            self.store.clear()
+
+        if start:
+            self.start()
+
+    # 启动定期写入存储的后台线程
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='aureus-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # 后台线程主循环
+    def run(self):
+        while self.running:
+            time.sleep(self.store.interval)
+
+            # 写入失败时不能让后台线程退出
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    # 停止后台线程，写入剩余的计数并删除本进程的瞬时值，进程正常退出前调用
+    def stop(self):
+        if self.store is None or self.thread is None or not self.running:
+            return
+
+        self.running = False
+
+        try:
+            self.flush()
+            self.store.remove()
+        except Exception:
+            pass
+
+    # fork 出的子进程中没有后台线程，需要重新启动，父进程尚未写入的计数由父进程负责
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.requests, self.errors, self.latency, self.sizes = {}, {}, {}, {}
+        self.active = set()
+
+        if self.running:
+            self.start()
+
+    # 清空当前进程的指标
+    def reset(self):
+        with self.lock:
+            self.requests, self.errors, self.latency, self.sizes = {}, {}, {}, {}
+
+        if self.store is not None:
+            self.store.clear()
+
+
+# 统计流式响应的大小，响应发送完（close 被调用）时记录
+class BodyCounter:
+    def __init__(self, registry, iterable, endpoint):
+        self.registry = registry    # 指标注册表
+        self.iterable = iterable    # 原响应内容
+        self.endpoint = endpoint    # 节点名
+        self.size = 0               # 已发送的字节数
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.registry.observe_size(self.endpoint, self.size)
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
+
+# 框架异常转换为响应体时记录异常编号
+exceptions.error_hooks.append(metrics.record_error)
+
+# fork 出的子进程重新启动后台线程
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.after_fork)
@@ -0,0 +1,156 @@
+import re
+import time
+import logging
+import threading
+from collections import deque
+from contextvars import ContextVar
+from functools import lru_cache
+
+
+# 慢查询与 N+1 查询警告的日志
+logger = logging.getLogger('aureus.db')
+
+# 字符串、数字等字面量
+literal_comp = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b|%\(\w+\)s|%s", re.I)
+
+# 由占位符组成的列表，例如 IN (?, ?, ?) 或多行 VALUES (?, ?), (?, ?)
+list_comp = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+
+# 超过该长度的语句不缓存指纹
+FINGERPRINT_CACHE_LENGTH = 4096
+
+# 计算语句指纹，字面量与参数占位符替换为 ?，占位符列表合并为 (?+)，只有参数不同的语句指纹相同
+def fingerprint(sql):
+    if len(sql) <= FINGERPRINT_CACHE_LENGTH:
+        return cached_fingerprint(sql)
+
+    return compute_fingerprint(sql)
+
+# 计算语句指纹
+def compute_fingerprint(sql):
+    sql = literal_comp.sub('?', sql)
+    sql = list_comp.sub('(?+)', sql)
+    return ' '.join(sql.split()).lower()
+
+# 带缓存的语句指纹，同一条语句通常会被反复执行
+cached_fingerprint = lru_cache(maxsize=4096)(compute_fingerprint)
+
+# 当前请求的查询统计
+current_scope = ContextVar('aureus_query_scope', default=None)
+
+# 单个请求内的查询统计
+class RequestScope:
+    def __init__(self):
+        self.queries = 0        # 查询次数
+        self.time = 0.0         # 查询总耗时
+        self.counts = {}        # 指纹 -> 执行次数
+        self.sticky = {}        # 数据库模块 -> 写操作之后只使用主库的截止时间
+
+
+# 查询分析器，记录每条语句的耗时与行数，按指纹与请求节点汇总，并记录慢查询与疑似 N+1 查询
+class QueryProfiler:
+    def __init__(self, slow_threshold=1.0, n_plus_one=20, slow_log_size=100):
+        self.enabled = True                             # 是否开启记录
+        self.slow_threshold = slow_threshold            # 慢查询阈值，单位为秒
+        self.n_plus_one = n_plus_one                    # 同一请求内同一指纹的执行次数超过该值时视为疑似 N+1 查询
+        self.slow_log = deque(maxlen=slow_log_size)     # 最近的慢查询，元素为字典
+        self.queries = {}                               # 指纹 -> [执行次数, 总耗时, 最大耗时, 总行数]
+        self.endpoints = {}                             # 节点名 -> [请求数, 查询次数, 查询总耗时, 单个请求最多查询次数]
+        self.lock = threading.Lock()
+
+    # 开始统计一个请求内的查询，返回用于结束统计的令牌
+    def begin(self):
+        return current_scope.set(RequestScope())
+
+    # 结束请求内的查询统计并按节点汇总，返回该请求的统计
+    def end(self, token, endpoint):
+        scope = current_scope.get()
+        current_scope.reset(token)
+
+        if scope is None or not scope.queries:
+            return scope
+
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+
+            if stats is None:
+                stats = self.endpoints[endpoint] = [0, 0, 0.0, 0]
+
+            stats[0] += 1
+            stats[1] += scope.queries
+            stats[2] += scope.time
+            stats[3] = max(stats[3], scope.queries)
+
+        return scope
+
+    # 记录一次查询，key 为语句指纹，为空时根据语句计算
+    def record(self, sql, duration, rows, key=None):
+        if not self.enabled:
+            return
+
+        if key is None:
+            key = fingerprint(sql)
+
+        with self.lock:
+            stats = self.queries.get(key)
+
+            if stats is None:
+                stats = self.queries[key] = [0, 0.0, 0.0, 0]
+
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3] += rows or 0
+
+        # 慢查询
+        if duration >= self.slow_threshold:
+            self.slow_log.append({'fingerprint': key, 'sql': sql[:FINGERPRINT_CACHE_LENGTH], 'time': duration, 'rows': rows, 'at': time.time()})
+            logger.warning('Slow query (%.3fs, %s rows): %s', duration, rows, sql[:FINGERPRINT_CACHE_LENGTH])
+
+        # 请求内统计，同一指纹刚超过阈值时警告一次
+        scope = current_scope.get()
+        if scope is not None:
+            scope.queries += 1
+            scope.time += duration
+            count = scope.counts[key] = scope.counts.get(key, 0) + 1
+
+            if count == self.n_plus_one + 1:
+                logger.warning('Possible N+1 query, executed more than %d times in one request: %s', self.n_plus_one, key)
+
+    # 按总耗时（或 count、max、rows）排序的前 n 个指纹
+    def top(self, n=10, order='time'):
+        index = {'count': 0, 'time': 1, 'max': 2, 'rows': 3}[order]
+
+        with self.lock:
+            items = sorted(self.queries.items(), key=lambda item: item[1][index], reverse=True)[:n]
+
+        return [{
+            'fingerprint': key,
+            'count': count,
+            'time': total,
+            'avg': total / count,
+            'max': longest,
+            'rows': rows
+        } for key, (count, total, longest, rows) in items]
+
+    # 按节点汇总的查询统计
+    def endpoint_stats(self):
+        with self.lock:
+            return {endpoint: {
+                'requests': requests,
+                'queries': queries,
+                'time': total,
+                'avg_queries': queries / requests,
+                'max_queries': most
+            } for endpoint, (requests, queries, total, most) in self.endpoints.items()}
+
+    # 清空统计
+    def reset(self):
+        with self.lock:
+            self.queries.clear()
+            self.endpoints.clear()
+            self.slow_log.clear()
+
+
+# 全局查询分析器
+profiler = QueryProfiler()
@@ -1,3 +1,24 @@
+import re
+import aureus.exceptions as exceptions
+
+
+# 路径参数转换器，格式为 名字: (匹配正则, 类型转换函数, 匹配优先级)，优先级越小越先尝试
+CONVERTER_MAP = {
+    'int': (r'\d+', int, 1),
+    'float': (r'\d+\.\d+', float, 2),
+    'string': (r'[^/]+', str, 3),
+    'path': (r'.+', str, 4),
+}
+
+# 单独成段的 path 参数的优先级
+PATH_PRIORITY = CONVERTER_MAP['path'][2] + 10
+
+# 路径参数标记，例如 <int:id> 或 <name>
+rule_pattern = re.compile(r'<(?:([a-zA-Z_][a-zA-Z0-9_]*):)?([a-zA-Z_][a-zA-Z0-9_]*)>')
+
+# 匹配任意请求方法的标记，视图类型的处理函数由视图内部自行分发请求方法
+ANY_METHOD = '*'
+
 # 路由装饰器
 class Route:
     def __init__(self, app):
@@ -15,4 +36,232 @@ class Route:
             self.app.add_url_rule(url, f, 'route', **options)
             return f
 
-        return decorator
\ No newline at end of file
+        return decorator
+
+
+# 解析单个路径片段，返回 (匹配正则, 参数列表, 优先级)，纯静态片段返回 None
+def parse_segment(segment):
+    # 查找片段中的所有参数标记
+    matches = list(rule_pattern.finditer(segment))
+
+    # 没有参数标记，说明是静态片段
+    if not matches:
+        return None
+
+    regex = ''
+    args = []
+    priority = 0
+    pos = 0
+
+    for match in matches:
+        # 获取转换器名字，未指定时默认为 string
+        converter = match.group(1) or 'string'
+
+        # 未知转换器直接抛出异常，避免在请求期才暴露问题
+        if converter not in CONVERTER_MAP:
+            raise ValueError('Unknown converter: %s' % converter)
+
+        pattern, convert, level = CONVERTER_MAP[converter]
+
+        # 拼接参数前的静态部分与参数本身的正则
+        regex += re.escape(segment[pos:match.start()]) + '(%s)' % pattern
+        args.append((match.group(2), convert))
+        priority = max(priority, level)
+        pos = match.end()
+
+    regex += re.escape(segment[pos:])
+
+    # 带有静态前后缀的片段比纯参数片段更具体，优先尝试
+    if len(matches) == 1 and matches[0].start() == 0 and matches[0].end() == len(segment):
+        priority += 10
+
+    return re.compile('^%s$' % regex), args, priority
+
+
+# 获取路由规则的形状，参数名替换为转换器名，形状相同的规则在路由树中匹配同样的路径
+# 同时检查转换器，未知转换器在添加规则时直接抛出异常，避免在请求期才暴露问题
+def rule_shape(url):
+    segments = []
+
+    for segment in split_path(url):
+        for converter, _ in rule_pattern.findall(segment):
+            if (converter or 'string') not in CONVERTER_MAP:
+                raise ValueError('Unknown converter: %s' % converter)
+
+        segments.append(rule_pattern.sub(lambda match: '<%s>' % (match.group(1) or 'string'), segment))
+
+    return '/'.join(segments)
+
+
+# 路由树节点
+class Node:
+    def __init__(self):
+        self.static = {}        # 静态子节点，片段 -> 节点
+        self.dynamic = []       # 参数子节点，元素为 (优先级, 匹配正则, 参数列表, 节点)
+        self.path = []          # 路径参数子节点，元素为 (参数名, 节点)，会吞掉一个或多个片段
+        self.handlers = None    # 请求方法 -> 节点名 的分发表，为空表示该节点不是终点
+
+    # 获取或创建参数子节点
+    def child(self, segment):
+        parsed = parse_segment(segment)
+
+        # 静态片段直接放进字典中
+        if parsed is None:
+            return self.static.setdefault(segment, Node())
+
+        regex, args, priority = parsed
+
+        # 单独的 path 类型参数会匹配一个或多个片段，参数名相同的共用一个节点
+        if priority == PATH_PRIORITY:
+            for name, node in self.path:
+                if name == args[0][0]:
+                    return node
+
+            node = Node()
+            self.path.append((args[0][0], node))
+            return node
+
+        # 正则与参数名都相同的参数片段才共用一个节点，参数名不同的规则各自记录自己的参数名
+        for item in self.dynamic:
+            if item[1].pattern == regex.pattern and [name for name, _ in item[2]] == [name for name, _ in args]:
+                return item[3]
+
+        node = Node()
+        self.dynamic.append((priority, regex, args, node))
+        self.dynamic.sort(key=lambda item: item[0])
+        return node
+
+
+# 编译型路由表，以路径片段构建的前缀树，查找开销只与路径深度有关，与路由数量无关
+class Router:
+    def __init__(self):
+        self.rules = []         # 已注册的路由规则，元素为 (URL, 节点名, 请求方法列表)
+        self.shapes = {}        # 规则形状 -> 已注册的请求方法集合，用于检查冲突
+        self.root = None        # 编译后的路由树根节点
+        self.exact_map = {}     # 不含参数的 URL 直接映射到分发表，命中时不需要遍历路由树
+        self.compiled = False   # 是否已编译
+
+    # 添加路由规则，添加后需要重新编译
+    def add(self, url, endpoint, methods=None):
+        self.shapes.setdefault(rule_shape(url), set()).update(m.upper() for m in (methods or [ANY_METHOD]))
+        self.rules.append((url, endpoint, methods))
+        self.compiled = False
+
+    # 编译路由树
+    def compile(self):
+        root = Node()
+        exact_map = {}
+
+        for url, endpoint, methods in self.rules:
+            # 逐级创建路由树节点
+            node = root
+            for segment in split_path(url):
+                node = node.child(segment)
+
+            if node.handlers is None:
+                node.handlers = {}
+
+            # 填充请求方法分发表，未定义请求方法的规则匹配任意方法
+            for method in (methods or [ANY_METHOD]):
+                node.handlers[method.upper()] = endpoint
+
+            # 纯静态 URL 额外登记到精确映射表中，绕过路由树查找
+            if rule_pattern.search(url) is None:
+                exact_map[url] = node.handlers
+
+        self.root = root
+        self.exact_map = exact_map
+        self.compiled = True
+
+    # 判断路由规则是否冲突，形状相同（只有参数名不同也算）且请求方法有交集即视为冲突
+    def conflict(self, url, methods=None):
+        rule_methods = self.shapes.get(rule_shape(url))
+
+        if not rule_methods:
+            return False
+
+        methods = set(m.upper() for m in (methods or [ANY_METHOD]))
+
+        return ANY_METHOD in methods or ANY_METHOD in rule_methods or bool(methods & rule_methods)
+
+    # 根据路径与请求方法查找节点名与路径参数
+    def match(self, path, method):
+        # 未编译或者有新规则加入时先编译
+        if not self.compiled:
+            self.compile()
+
+        # 优先从精确映射表中查找
+        handlers = self.exact_map.get(path)
+        params = {}
+
+        if handlers is None:
+            ret = match_node(self.root, split_path(path), 0, params)
+
+            if ret is None:
+                # 抛出页面未找到异常
+                raise exceptions.PageNotFoundError
+
+            handlers = ret.handlers
+
+        # 从分发表中取出请求方法对应的节点
+        endpoint = handlers.get(method) or handlers.get(ANY_METHOD)
+
+        if endpoint is None:
+            # 抛出请求方法不支持异常
+            raise exceptions.InvalidRequestMethodError
+
+        return endpoint, params
+
+
+# 获取路由规则中的全部参数名
+def parse_rule_args(url):
+    return tuple(name for _, name in rule_pattern.findall(url))
+
+
+# 把路径按 “/” 分割成片段，根路径返回空列表
+def split_path(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+# 在路由树中递归匹配路径片段，成功时把参数写入 params 并返回终点节点
+def match_node(node, segments, index, params):
+    # 所有片段都已匹配，判断当前节点是否为终点
+    if index == len(segments):
+        return node if node.handlers is not None else None
+
+    segment = segments[index]
+
+    # 优先匹配静态片段
+    child = node.static.get(segment)
+    if child is not None:
+        ret = match_node(child, segments, index + 1, params)
+        if ret is not None:
+            return ret
+
+    # 其次按优先级尝试参数片段
+    for _, regex, args, child in node.dynamic:
+        match = regex.match(segment)
+        if match is None:
+            continue
+
+        # 尝试转换参数类型，失败则视为不匹配
+        try:
+            values = [convert(value) for (_, convert), value in zip(args, match.groups())]
+        except ValueError:
+            continue
+
+        ret = match_node(child, segments, index + 1, params)
+        if ret is not None:
+            for (name, _), value in zip(args, values):
+                params[name] = value
+            return ret
+
+    # 最后尝试 path 参数，从吞掉一个片段开始逐段增加，后面还有其它片段的规则（例如 <path:p>/edit）优先匹配结尾的片段
+    for end in range(index + 1, len(segments) + 1):
+        for name, child in node.path:
+            ret = match_node(child, segments, end, params)
+            if ret is not None:
+                params[name] = '/'.join(segments[index:end])
+                return ret
+
+    return None
@@ -0,0 +1,709 @@
+import os
+import sys
+import time
+import select
+import signal
+import socket
+import logging
+import threading
+from socketserver import BaseServer
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import unquote_to_bytes
+from concurrent.futures import ThreadPoolExecutor
+from aureus.session import session
+from aureus.metrics import metrics
+
+
+# 多进程服务器的运行日志
+logger = logging.getLogger('aureus.server')
+
+# 请求行的最大长度
+MAX_REQUEST_LINE = 65536
+
+# 响应结束后最多读取并丢弃的剩余请求体字节数，超过时直接关闭连接
+MAX_DRAIN = 1024 * 1024
+
+# 读取请求体的块大小
+READ_SIZE = 65536
+
+# 工作进程启动后在该秒数内异常退出时，延迟重新创建，避免反复崩溃占满 CPU
+RESPAWN_DELAY = 1.0
+
+# 建立监听套接字，reuse_port 为 True 时每个工作进程各自监听同一端口，由内核分配连接
+def bind_socket(host, port, backlog=2048, reuse_port=False):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.bind((host, port))
+        sock.listen(backlog)
+    except Exception:
+        sock.close()
+        raise
+
+    # 多个进程共享同一个监听套接字时，连接可能已经被其它进程取走，accept 不能阻塞
+    sock.setblocking(False)
+    return sock
+
+# 请求体，按 Content-Length 或分块传输编码读取，不会读到下一个请求的内容
+class InputStream:
+    def __init__(self, rfile, length=0, chunked=False):
+        self.rfile = rfile          # 连接的读缓冲
+        self.chunked = chunked      # 是否为分块传输编码
+        self.remaining = length     # 当前可以读取的字节数，分块传输时为当前分块剩余的字节数
+        self.started = False        # 是否已经读取过分块头
+        self.done = not chunked     # 分块传输是否已经读到结尾
+
+    # 当前可以读取的字节数，分块传输时当前分块读完后读取下一个分块头
+    def available(self):
+        if self.remaining or self.done:
+            return self.remaining
+
+        # 上一个分块之后的换行
+        if self.started:
+            self.rfile.readline(MAX_REQUEST_LINE)
+
+        self.started = True
+        line = self.rfile.readline(MAX_REQUEST_LINE)
+        size = int(line.split(b';', 1)[0].strip(), 16)
+
+        # 最后一个分块，跳过尾部报头
+        if size == 0:
+            while self.rfile.readline(MAX_REQUEST_LINE) not in (b'\r\n', b'\n', b''):
+                pass
+            self.done = True
+
+        self.remaining = size
+        return size
+
+    # 读取不超过 size 字节，line 为 True 时读到换行为止
+    def take(self, size, line):
+        parts = []
+
+        while size != 0:
+            available = self.available()
+
+            if not available:
+                break
+
+            n = available if size < 0 else min(size, available)
+            data = self.rfile.readline(n) if line else self.rfile.read(n)
+
+            if not data:
+                raise ConnectionResetError('Client disconnected before the request body was complete')
+
+            self.remaining -= len(data)
+            parts.append(data)
+
+            if size > 0:
+                size -= len(data)
+
+            if line and data.endswith(b'\n'):
+                break
+
+        return b''.join(parts)
+
+    def read(self, size=-1):
+        return self.take(-1 if size is None else size, False)
+
+    def readline(self, size=-1):
+        return self.take(-1 if size is None else size, True)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+
+            if not line:
+                return
+
+            yield line
+
+    # 丢弃处理函数没有读取的请求体，连接才能继续处理下一个请求，剩余内容过多时返回 False
+    def drain(self, limit=MAX_DRAIN):
+        while limit > 0:
+            data = self.read(min(READ_SIZE, limit))
+
+            if not data:
+                return True
+
+            limit -= len(data)
+
+        return not self.available()
+
+# wsgi.file_wrapper，完整的静态文件直接通过 sendfile 发送，不经过用户态缓冲
+class FileWrapper:
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike    # 文件对象
+        self.blksize = blksize      # 无法使用 sendfile 时逐块读取的块大小
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+
+            if not data:
+                return
+
+            yield data
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+# HTTP/1.1 请求处理，同一连接可以连续处理多个请求（keep-alive），没有长度的响应使用分块传输编码
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'AUREUS'
+    sys_version = ''
+    disable_nagle_algorithm = True      # 关闭 Nagle 算法，小响应不会被延迟发送
+    wbufsize = READ_SIZE                # 响应报头与响应体合并写入，减少系统调用
+
+    def setup(self):
+        # 空闲连接等待下一个请求的超时时间
+        self.timeout = self.server.keep_alive
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except (ConnectionError, socket.timeout):
+            # 客户端断开或空闲超时
+            pass
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > MAX_REQUEST_LINE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        # 达到最大请求数或服务器正在停止时，本次响应之后关闭连接
+        if self.server.count_request():
+            self.close_connection = True
+
+        self.run_wsgi()
+        self.wfile.flush()
+
+    # 构造 WSGI 环境
+    def make_environ(self):
+        path, _, query = self.path.partition('?')
+
+        # 绝对形式的请求目标，例如 GET http://example.com/path HTTP/1.1
+        if '://' in path:
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'REMOTE_PORT': str(self.client_address[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': self.body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.input_terminated': True,      # 请求体由 InputStream 限定长度，分块请求也可以直接读到结尾
+            'wsgi.file_wrapper': FileWrapper
+        }
+
+        for name, value in self.headers.items():
+            # 带下划线的报头名与连字符的报头名无法区分，忽略
+            if '_' in name:
+                continue
+
+            key = name.upper().replace('-', '_')
+
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+
+            # 重复的报头合并为一个，Cookie 以分号分隔
+            if key in environ:
+                environ[key] += ('; ' if key == 'HTTP_COOKIE' else ',') + value
+            else:
+                environ[key] = value
+
+        return environ
+
+    # 调用应用处理请求
+    def run_wsgi(self):
+        chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+
+        try:
+            length = 0 if chunked else int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, 'Invalid Content-Length')
+            return
+
+        self.body = InputStream(self.rfile, length, chunked)
+        self.status = None
+        self.response_headers = None
+        self.headers_sent = False
+        self.chunked = False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if self.headers_sent:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            elif self.status is not None:
+                raise AssertionError('Headers already set')
+
+            self.status = status
+            self.response_headers = headers
+            return self.write
+
+        try:
+            app_iter = self.server.app(self.make_environ(), start_response)
+
+            try:
+                if not (isinstance(app_iter, FileWrapper) and self.send_file(app_iter.filelike)):
+                    for chunk in app_iter:
+                        if chunk:
+                            self.write(chunk)
+
+                self.finish_response()
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        except (ConnectionError, socket.timeout):
+            raise
+        except Exception:
+            logger.exception('Error handling request %s %s', self.command, self.path)
+            self.close_connection = True
+
+            # 报头还没有发送时返回 500 响应
+            if not self.headers_sent:
+                self.send_error(500)
+            return
+
+        # 丢弃没有读取的请求体
+        if not self.close_connection and not self.body.drain():
+            self.close_connection = True
+
+    # 发送响应报头，没有 Content-Length 的响应使用分块传输编码，HTTP/1.0 则在发送完后关闭连接
+    def send_headers(self):
+        code, _, reason = self.status.partition(' ')
+        code = int(code)
+        names = set()
+
+        # Server 报头由应用设置
+        self.log_request(code)
+        self.send_response_only(code, reason)
+        self.send_header('Date', self.date_time_string())
+
+        for name, value in self.response_headers:
+            names.add(name.lower())
+            self.send_header(name, value)
+
+        if 'content-length' not in names and self.command != 'HEAD' and code >= 200 and code not in (204, 304):
+            if self.request_version == 'HTTP/1.1':
+                self.chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.close_connection = True
+
+        if 'connection' not in names:
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+
+        self._headers_buffer.append(b'\r\n')
+        self.wfile.write(b''.join(self._headers_buffer))
+        self._headers_buffer = []
+        self.headers_sent = True
+
+    # WSGI 的 write，第一次写入时先发送报头
+    def write(self, data):
+        if self.status is None:
+            raise AssertionError('write() before start_response()')
+
+        if not self.headers_sent:
+            self.send_headers()
+
+        if self.command == 'HEAD' or not data:
+            return
+
+        if self.chunked:
+            self.wfile.write(b'%x\r\n' % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b'\r\n')
+
+            # 分块输出的内容（流式模版、长轮询等）需要立即到达客户端
+            self.wfile.flush()
+        else:
+            self.wfile.write(data)
+
+    # 响应结束
+    def finish_response(self):
+        if not self.headers_sent:
+            self.send_headers()
+
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    # 通过 sendfile 发送完整文件，无法使用时返回 False，由调用方逐块发送
+    def send_file(self, f):
+        if self.status is None or self.command == 'HEAD' or not hasattr(f, 'fileno'):
+            return False
+
+        length = None
+        for name, value in self.response_headers:
+            if name.lower() == 'content-length':
+                length = int(value)
+
+        if length is None:
+            return False
+
+        try:
+            offset = f.tell()
+            f.fileno()
+        except (OSError, ValueError, AttributeError):
+            return False
+
+        self.send_headers()
+        self.wfile.flush()
+        self.connection.sendfile(f, offset, length)
+        return True
+
+    # 访问日志，只在开启调试日志时记录
+    def log_request(self, code='-', size='-'):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s "%s" %s', self.address_string(), self.requestline, code)
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+# 工作进程内的服务器，接受到的连接交给线程池处理
+class WorkerServer(BaseServer):
+    def __init__(self, sock, app, threads=8, keep_alive=5, max_requests=0):
+        BaseServer.__init__(self, sock.getsockname(), RequestHandler)
+        self.socket = sock                              # 监听套接字
+        self.app = app                                  # WSGI 应用
+        self.keep_alive = keep_alive                    # 空闲连接保持的秒数
+        self.max_requests = max_requests                # 处理该数量的请求后退出，由主进程重新创建，为 0 时不限制
+        self.requests = 0                               # 已处理的请求数量
+        self.stopping = False                           # 是否正在停止
+        self.slots = threading.BoundedSemaphore(threads)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='aureus-worker')
+        self.lock = threading.Lock()
+
+        address = sock.getsockname()
+        self.server_name = address[0]
+        self.server_port = address[1]
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    # 线程全部被占用时不接受新连接，让其它工作进程处理
+    def get_request(self):
+        if not self.slots.acquire(timeout=0.1):
+            raise BlockingIOError()
+
+        try:
+            return self.socket.accept()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def shutdown_request(self, request):
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+        request.close()
+
+    def handle_error(self, request, client_address):
+        logger.exception('Error handling connection from %s', client_address[0])
+
+    # 记录一次请求，返回连接是否应当关闭
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+            recycle = self.max_requests and self.requests >= self.max_requests
+
+        if recycle:
+            self.stop()
+
+        return self.stopping
+
+    # 平滑停止，不再接受新连接，正在处理的请求处理完后退出
+    def stop(self):
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+
+        threading.Thread(target=self.shutdown, daemon=True).start()
+
+# 主进程退出后工作进程自行停止
+def watch_parent(server, ppid):
+    while not server.stopping:
+        time.sleep(1)
+
+        if os.getppid() != ppid:
+            server.stop()
+
+# 工作进程主函数
+def run_worker(app, sock, threads, keep_alive, max_requests):
+    server = WorkerServer(sock, app, threads, keep_alive, max_requests)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+    watcher = threading.Thread(target=watch_parent, args=(server, os.getppid()), daemon=True)
+    watcher.start()
+
+    try:
+        server.serve_forever(poll_interval=0.5)
+    finally:
+        # 等待正在处理的请求结束，写完后台会话
+        server.executor.shutdown(wait=True)
+
+        if session.writer is not None:
+            session.writer.stop()
+
+        # 写入剩余的运行指标
+        metrics.stop()
+
+# 把 waitpid 得到的状态转换为退出码，被信号终止时为负的信号编号，Python 3.9 之前没有 os.waitstatus_to_exitcode
+def exit_code(status):
+    if hasattr(os, 'waitstatus_to_exitcode'):
+        return os.waitstatus_to_exitcode(status)
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+# 多进程服务器的主进程，负责创建、回收与替换工作进程
+# SIGTERM / SIGINT：平滑停止；SIGQUIT：立即停止；SIGHUP：平滑重启，先创建新的工作进程，再停止旧的工作进程
+class Arbiter:
+    def __init__(self, app, host, port, workers=None, threads=8, max_requests=0, max_requests_jitter=0,
+                 keep_alive=5, graceful_timeout=30, reuse_port=False, backlog=2048):
+        self.app = app                                  # WSGI 应用
+        self.host = host                                # 监听地址
+        self.port = port                                # 监听端口
+        self.num_workers = workers or os.cpu_count() or 1   # 工作进程数量，默认为 CPU 核数
+        self.threads = threads                          # 每个工作进程的线程数量
+        self.max_requests = max_requests                # 工作进程处理该数量的请求后重新创建，为 0 时不限制
+        self.max_requests_jitter = max_requests_jitter  # 最大请求数的随机增量，避免工作进程同时重新创建
+        self.keep_alive = keep_alive                    # 空闲连接保持的秒数
+        self.graceful_timeout = graceful_timeout        # 平滑停止时等待工作进程退出的秒数，超时后强制结束
+        self.reuse_port = reuse_port                    # 是否使用 SO_REUSEPORT 让每个工作进程各自监听
+        self.backlog = backlog                          # 监听队列长度
+        self.socket = None                              # 共享的监听套接字
+        self.workers = {}                               # 工作进程 PID -> 启动时间
+        self.retiring = {}                              # 正在停止的工作进程 PID -> 强制结束的时间
+        self.signals = []                               # 待处理的信号
+        self.stopping = False                           # 是否正在停止
+        self.respawn_at = 0                             # 工作进程反复崩溃时，在该时间之后才重新创建
+        self.pipe = None                                # 信号唤醒主循环的管道
+
+    # 信号处理函数只记录信号，在主循环中处理
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+        try:
+            os.write(self.pipe[1], b'.')
+        except OSError:
+            pass
+
+    # 创建一个工作进程
+    def spawn(self):
+        pid = os.fork()
+
+        if pid:
+            self.workers[pid] = time.time()
+            return
+
+        # 工作进程
+        code = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT, signal.SIGCHLD):
+                signal.signal(signum, signal.SIG_DFL)
+
+            # Ctrl+C 由主进程统一处理
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+
+            sock = self.socket or bind_socket(self.host, self.port, self.backlog, reuse_port=True)
+
+            max_requests = self.max_requests
+            if max_requests and self.max_requests_jitter:
+                max_requests += int.from_bytes(os.urandom(4), 'big') % (self.max_requests_jitter + 1)
+
+            run_worker(self.app, sock, self.threads, self.keep_alive, max_requests)
+        except BaseException:
+            logger.exception('Worker %d failed', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    # 回收已退出的工作进程
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if not pid:
+                return
+
+            started = self.workers.pop(pid, None)
+            self.retiring.pop(pid, None)
+            code = exit_code(status)
+
+            if started is not None and code != 0 and not self.stopping:
+                logger.error('Worker %d exited with code %d', pid, code)
+
+                # 启动后很快就崩溃，延迟重新创建
+                if time.time() - started < RESPAWN_DELAY:
+                    self.respawn_at = time.time() + RESPAWN_DELAY
+
+    # 向工作进程发送信号
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    # 让工作进程平滑停止，超时后强制结束
+    def retire(self, pids):
+        deadline = time.time() + self.graceful_timeout
+
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.retiring[pid] = deadline
+            self.kill(pid, signal.SIGTERM)
+
+    # 补足工作进程数量，强制结束停止超时的工作进程
+    def maintain(self):
+        now = time.time()
+
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                logger.warning('Worker %d did not stop in time, killing it', pid)
+                self.kill(pid, signal.SIGKILL)
+                self.retiring[pid] = now + self.graceful_timeout
+
+        if self.stopping or now < self.respawn_at:
+            return
+
+        while len(self.workers) < self.num_workers:
+            self.spawn()
+
+    # 处理信号
+    def handle_signals(self):
+        signals, self.signals = self.signals, []
+
+        for signum in signals:
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self.stopping = True
+                self.retire(list(self.workers))
+            elif signum == signal.SIGQUIT:
+                self.stopping = True
+                self.retire(list(self.workers))
+                for pid in self.retiring:
+                    self.kill(pid, signal.SIGKILL)
+            elif signum == signal.SIGHUP and not self.stopping:
+                logger.info('Reloading workers')
+                old = list(self.workers)
+                self.workers.clear()
+                self.maintain()
+                self.retire(old)
+
+    # 等待信号或者超时
+    def sleep(self, timeout):
+        try:
+            ready = select.select([self.pipe[0]], [], [], timeout)[0]
+        except InterruptedError:
+            return
+
+        if ready:
+            try:
+                while os.read(self.pipe[0], 4096):
+                    pass
+            except OSError:
+                pass
+
+    def run(self):
+        # 完成路由编译与会话存储等准备工作，工作进程直接继承
+        if not self.app.prepared:
+            self.app.prepare()
+
+        if not self.reuse_port:
+            self.socket = bind_socket(self.host, self.port, self.backlog)
+
+        self.pipe = os.pipe()
+        for fd in self.pipe:
+            os.set_blocking(fd, False)
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, self.on_signal)
+
+        sys.stderr.write(' * Running on http://%s:%d/ (%d workers, %d threads each, Press CTRL+C to quit)\n' % (
+            self.host, self.port, self.num_workers, self.threads))
+
+        try:
+            self.maintain()
+
+            while not self.stopping or self.workers or self.retiring:
+                self.sleep(1.0)
+                self.handle_signals()
+                self.reap()
+                self.maintain()
+        finally:
+            # 主进程异常退出时结束全部工作进程
+            for pid in list(self.workers) + list(self.retiring):
+                self.kill(pid, signal.SIGKILL)
+
+            if self.socket is not None:
+                self.socket.close()
+
+            for fd in self.pipe:
+                os.close(fd)
+
+# 以多进程模式运行应用，参数见 Arbiter
+def serve(app, host, port, workers=None, **options):
+    Arbiter(app, host, port, workers, **options).run()
@@ -2,17 +2,463 @@ import os
 import json
 import base64
 import time
+import zlib
+import hmac
+import atexit
+import logging
+import hashlib
+import tempfile
+import sqlite3
+import threading
+from collections import OrderedDict
+from werkzeug.http import dump_cookie
+import aureus.exceptions as exceptions
 
 
+# 会话写入失败等警告的日志
+logger = logging.getLogger('aureus.session')
+
+# 会话锁的分段数量，不同的会话大概率落在不同的锁上，互不阻塞
+LOCK_STRIPES = 64
+
 # 创建 Session ID
 def create_session_id():
-    # 首先获取当前时间戳，转换为字符串，编码为字节流，在 Base64 编码，在解码为字符串，然后去掉 Base64 编码会出现的“=”号，取到倒数第二位，最后再进行倒序排列
-    return base64.encodebytes(str(time.time()).encode()).decode().replace("=", '')[:-2][::-1]
+    # 使用系统随机数生成，以时间戳生成的 ID 在多线程下同一时刻创建的会话会重复
+    return base64.urlsafe_b64encode(os.urandom(18)).decode()
 
 # 从请求中获取 Session ID
 def get_session_id(request):
     return request.cookies.get('session_id', '')
 
+# 请求环境中记录本次请求修改过的 Session ID 的键
+DIRTY_KEY = 'aureus.session.dirty'
+
+# 请求环境中存放 Cookie 会话记录的键
+COOKIE_KEY = 'aureus.session.cookie'
+
+# 序列化会话数据，使用紧凑的 JSON 字节流，不再做 base64 包装
+def dumps(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+# 反序列化会话数据
+def loads(content):
+    return json.loads(content.decode())
+
+# 会话记录，包含会话数据与创建、访问时间
+class SessionRecord:
+
+    def __init__(self, data=None, created=None, accessed=None):
+        now = time.time()
+        self.data = data if data is not None else {}                # 会话数据
+        self.created = created if created is not None else now      # 创建时间，用于判断绝对过期
+        self.accessed = accessed if accessed is not None else now   # 最近访问时间，用于判断闲置过期
+        self.stored_accessed = self.accessed                        # 已写入存储后端的访问时间
+
+    # 复制一份会话记录，写入存储后端时使用，避免写入过程中会话被其它请求修改
+    def copy(self):
+        return SessionRecord(dict(self.data), self.created, self.accessed)
+
+# 会话存储后端接口
+class SessionBackend:
+
+    # 读取会话记录，不存在时返回 None
+    def load(self, session_id):
+        raise NotImplementedError
+
+    # 读取会话记录最后一次写入时的访问时间，用于判断其它进程是否写入过该会话，不存在时返回 None
+    def stamp(self, session_id):
+        record = self.load(session_id)
+        return record.accessed if record is not None else None
+
+    # 保存会话记录
+    def save(self, session_id, record):
+        raise NotImplementedError
+
+    # 批量保存会话记录，参数为 (Session ID, 会话记录) 列表，支持事务的后端应一次性原子提交
+    def save_many(self, items):
+        for session_id, record in items:
+            self.save(session_id, record)
+
+    # 删除会话记录
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    # 返回全部 Session ID
+    def keys(self):
+        raise NotImplementedError
+
+    # 删除过期的会话，每次最多删除 limit 个，返回删除的数量
+    def sweep(self, created_before, accessed_before, limit):
+        count = 0
+
+        for session_id in self.keys():
+            if count >= limit:
+                break
+
+            record = self.load(session_id)
+
+            if record is not None and (record.created < created_before or record.accessed < accessed_before):
+                self.delete(session_id)
+                count += 1
+
+        return count
+
+# 每个会话一个文件的存储后端，兼容旧版本的存储格式，文件的修改时间即为会话的访问时间
+# 创建时间以 “#创建时间” 的首行写在 base64 内容之前，旧版本的文件没有这一行，以修改时间代替
+class FileBackend(SessionBackend):
+
+    def __init__(self, path):
+        # 会话本地存放目录
+        self.path = path
+
+    def load(self, session_id):
+        # 构造 Session 会话的本地文件路径，文件名为 Session ID
+        path = os.path.join(self.path, session_id)
+
+        # 读取文件中的内容
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            mtime = os.path.getmtime(path)
+        except (IOError, OSError):
+            return None
+
+        # 把文件内容进行 base64 解码，旧格式没有记录创建时间，以修改时间代替
+        created = mtime
+        if content.startswith(b'#'):
+            header, _, content = content.partition(b'\n')
+            created = float(header[1:])
+
+        return SessionRecord(loads(base64.decodebytes(content)), created, mtime)
+
+    def stamp(self, session_id):
+        try:
+            return os.path.getmtime(os.path.join(self.path, session_id))
+        except OSError:
+            return None
+
+    # 只读取文件首行获取创建时间，旧格式的文件返回修改时间
+    def created(self, path, mtime):
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline()
+        except (IOError, OSError):
+            return mtime
+
+        return float(header[1:]) if header.startswith(b'#') else mtime
+
+    def save(self, session_id, record):
+        path = os.path.join(self.path, session_id)
+
+        # 先写入同目录下的临时文件，再重命名覆盖原文件，读取方不会看到写了一半的文件
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # 进行 base64 编码再写入文件中，防止一些特定二进制数据无法正确写入
+                f.write(b'#%r\n' % record.created)
+                f.write(base64.encodebytes(json.dumps(record.data).encode()))
+
+            # 以文件修改时间记录访问时间
+            os.utime(temp_path, (record.accessed, record.accessed))
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def delete(self, session_id):
+        try:
+            os.remove(os.path.join(self.path, session_id))
+        except OSError:
+            pass
+
+    def keys(self):
+        # 文件名其实就是 Session ID，跳过以 “.” 开头的临时文件
+        return [name for name in os.listdir(self.path) if not name.startswith('.')]
+
+    def sweep(self, created_before, accessed_before, limit):
+        count = 0
+
+        # 闲置过期只检查文件修改时间，绝对过期才读取文件首行的创建时间，两个条件满足其一即删除
+        for session_id in self.keys():
+            if count >= limit:
+                break
+
+            path = os.path.join(self.path, session_id)
+
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            if mtime < accessed_before or created_before and self.created(path, mtime) < created_before:
+                self.delete(session_id)
+                count += 1
+
+        return count
+
+# 单文件 SQLite 存储后端，同一台机器上的多个工作进程可以共享同一个数据库文件
+class SQLiteBackend(SessionBackend):
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path                # 数据库文件路径
+        self.timeout = timeout          # 等待其它进程释放写锁的超时时间
+        self.local = threading.local()  # SQLite 连接不能跨线程使用，每个线程单独持有一个连接
+
+        # SQLite 连接也不能跨进程使用，多进程服务器 fork 出的子进程重新建立连接
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+        # 建表，并为过期清理建立索引
+        conn = self.connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS session '
+                         '(id TEXT PRIMARY KEY, data BLOB NOT NULL, created REAL NOT NULL DEFAULT 0, accessed REAL NOT NULL DEFAULT 0)')
+
+            # 兼容没有时间字段的旧表
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(session)')]
+            for column in ('created', 'accessed'):
+                if column not in columns:
+                    conn.execute('ALTER TABLE session ADD COLUMN %s REAL NOT NULL DEFAULT 0' % column)
+
+            conn.execute('CREATE INDEX IF NOT EXISTS session_created ON session (created)')
+            conn.execute('CREATE INDEX IF NOT EXISTS session_accessed ON session (accessed)')
+
+    # fork 之后丢弃父进程的连接
+    def after_fork(self):
+        self.local = threading.local()
+
+    # 获取当前线程的数据库连接
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+
+            # WAL 模式下读写互不阻塞，适合多进程共享
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+
+        return conn
+
+    def load(self, session_id):
+        row = self.connect().execute('SELECT data, created, accessed FROM session WHERE id = ?', (session_id,)).fetchone()
+        return SessionRecord(loads(bytes(row[0])), row[1], row[2]) if row is not None else None
+
+    def stamp(self, session_id):
+        row = self.connect().execute('SELECT accessed FROM session WHERE id = ?', (session_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, session_id, record):
+        self.save_many([(session_id, record)])
+
+    def save_many(self, items):
+        conn = self.connect()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO session (id, data, created, accessed) VALUES (?, ?, ?, ?)',
+                             [(session_id, sqlite3.Binary(dumps(record.data)), record.created, record.accessed)
+                              for session_id, record in items])
+
+    def delete(self, session_id):
+        conn = self.connect()
+        with conn:
+            conn.execute('DELETE FROM session WHERE id = ?', (session_id,))
+
+    def keys(self):
+        return [row[0] for row in self.connect().execute('SELECT id FROM session')]
+
+    def sweep(self, created_before, accessed_before, limit):
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute('DELETE FROM session WHERE id IN '
+                                  '(SELECT id FROM session WHERE created < ? OR accessed < ? LIMIT ?)',
+                                  (created_before, accessed_before, limit))
+        return cursor.rowcount
+
+# 把字节流编码为不带填充的 URL 安全 base64 字符串
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+# 解码不带填充的 URL 安全 base64 字符串
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+# 签名 Cookie 会话，会话数据序列化、压缩并签名后直接存放在客户端 Cookie 中，服务端不做任何存储读写，任意节点都能处理任意请求
+# Cookie 格式为 “数据.签名时间.签名”，数据以 “z” 开头表示经过压缩，以 “j” 开头表示未压缩的 JSON
+class SignedCookieStore:
+
+    def __init__(self, secret_keys, cookie_name='session', max_size=4093, secure=False, compress_min=64):
+        # 支持传入单个密钥，多个密钥时第一个用于签名，全部用于校验，轮换密钥时把新密钥放在最前面
+        if isinstance(secret_keys, (str, bytes)):
+            secret_keys = [secret_keys]
+
+        if not secret_keys:
+            raise ValueError('At least one secret key is required')
+
+        self.keys = [key.encode() if isinstance(key, str) else key for key in secret_keys]
+        self.cookie_name = cookie_name      # Cookie 名字
+        self.max_size = max_size            # Cookie 的最大字节数，浏览器通常只接受 4KB 以内的 Cookie
+        self.secure = secure                # 是否只在 HTTPS 下发送
+        self.compress_min = compress_min    # 序列化结果超过该字节数时尝试压缩
+
+    # 计算签名
+    def sign(self, key, payload):
+        return b64encode(hmac.new(key, payload.encode(), hashlib.sha256).digest())
+
+    # 把会话记录编码为 Cookie 值
+    def dumps(self, record):
+        body = dumps({'d': record.data, 'c': record.created})
+
+        # 压缩后更小时才使用压缩结果
+        if len(body) >= self.compress_min:
+            compressed = zlib.compress(body)
+            body = b'z' + compressed if len(compressed) < len(body) else b'j' + body
+        else:
+            body = b'j' + body
+
+        payload = '%s.%x' % (b64encode(body), int(record.accessed))
+        return '%s.%s' % (payload, self.sign(self.keys[0], payload))
+
+    # 从 Cookie 值解码会话记录，签名不正确或格式不合法时返回 None
+    def loads(self, value):
+        payload, _, signature = value.rpartition('.')
+
+        # 依次使用每个密钥校验签名
+        if not payload or not any(hmac.compare_digest(self.sign(key, payload), signature) for key in self.keys):
+            return None
+
+        try:
+            body, _, accessed = payload.partition('.')
+            body = b64decode(body)
+            body = zlib.decompress(body[1:]) if body[:1] == b'z' else body[1:]
+            content = loads(body)
+            record = SessionRecord(content['d'], content['c'], int(accessed, 16))
+        except (ValueError, KeyError, TypeError, zlib.error):
+            return None
+
+        return record
+
+    # 生成 Set-Cookie 报头的值
+    def header(self, value, max_age=None):
+        return dump_cookie(self.cookie_name, value, max_age=max_age, path='/',
+                           secure=self.secure, httponly=True, samesite='Lax')
+
+    # 检查会话编码后是否超出 Cookie 大小限制
+    def check(self, record):
+        if len(self.header(self.dumps(record))) > self.max_size:
+            raise exceptions.SessionTooLargeError
+
+# 后台会话写入线程，把会话写入从请求线程中移出，同一会话在写入前的多次修改只写入最后一次
+class SessionWriter:
+
+    def __init__(self, backend, on_saved=None):
+        self.backend = backend                  # 会话存储后端
+        self.on_saved = on_saved                # 会话写入后的回调，参数为本批写入的 Session ID 列表
+        self.pending = {}                       # 等待写入的会话，Session ID -> 会话记录
+        self.writing = {}                       # 正在写入的一批会话，写完之前同样需要能被读到
+        self.retry_delay = 1.0                  # 写入失败后重新写入前等待的秒数
+        self.condition = threading.Condition()
+        self.running = True
+
+        # 启动后台线程，进程退出前写完剩余的会话
+        self.thread = threading.Thread(target=self.run, name='aureus-session-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+        # fork 出的子进程中没有后台线程，需要重新启动
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    # fork 之后重新创建后台线程，fork 前提交的会话由父进程负责写入
+    def after_fork(self):
+        self.pending = {}
+        self.writing = {}
+        self.condition = threading.Condition()
+
+        if self.running:
+            self.thread = threading.Thread(target=self.run, name='aureus-session-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    # 提交待写入的会话
+    def submit(self, items):
+        merged = []
+
+        with self.condition:
+            for session_id, record in items:
+                # 同一会话还在等待写入时只保留最新的记录，合并掉的提交视为已写入
+                if session_id in self.pending:
+                    merged.append(session_id)
+                self.pending[session_id] = record
+            self.condition.notify()
+
+        if merged and self.on_saved is not None:
+            self.on_saved(merged)
+
+    # 获取尚未写入的会话记录，会话被淘汰出内存后再次访问时需要优先使用它
+    def get(self, session_id):
+        with self.condition:
+            record = self.pending.get(session_id)
+            return record if record is not None else self.writing.get(session_id)
+
+    # 后台线程主循环
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and self.running:
+                    self.condition.wait()
+
+                if not self.pending and not self.running:
+                    return
+
+                self.writing, self.pending = self.pending, {}
+                items = list(self.writing.items())
+
+            # 写入失败时不能让后台线程退出
+            try:
+                self.backend.save_many(items)
+            except Exception:
+                logger.exception('Failed to save %d sessions', len(items))
+                self.requeue(items)
+                continue
+
+            with self.condition:
+                self.writing = {}
+
+            if self.on_saved is not None:
+                self.on_saved([session_id for session_id, _ in items])
+
+    # 把写入失败的会话放回等待队列，会话保持未写入的标记，不会被淘汰出内存，等待一段时间后重新写入
+    # 期间又提交了同一会话时只写入更新的记录，失败的这次提交视为已合并；正在停止时不再重试
+    def requeue(self, items):
+        merged = []
+
+        with self.condition:
+            self.writing = {}
+
+            if not self.running:
+                logger.error('Dropped %d unsaved sessions on shutdown', len(items))
+                return
+
+            for session_id, record in items:
+                if session_id in self.pending:
+                    merged.append(session_id)
+                else:
+                    self.pending[session_id] = record
+
+            self.condition.wait(self.retry_delay)
+
+        if merged and self.on_saved is not None:
+            self.on_saved(merged)
+
+    # 停止后台线程，等待剩余的会话写完
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
 # 会话
 class Session:
 
@@ -22,15 +468,76 @@ class Session:
     # 初始化方法
     def __init__(self):
 
-        # 会话映射表
-        self.__session_map__ = {}
+        # 会话映射表，只存放最近被请求访问过的会话，按访问顺序排列，超出容量时淘汰最久未访问的会话
+        self.__session_map__ = OrderedDict()
+
+        # 会话存储后端
+        self.backend = None
+
+        # 后台会话写入线程，为空时在请求线程中写入
+        self.writer = None
+
+        # 签名 Cookie 会话，不为空时会话数据全部存放在客户端 Cookie 中，不再使用存储后端
+        self.cookie_store = None
+
+        self.max_sessions = 10000       # 内存中最多保留的会话数量，被淘汰的会话下次访问时从存储后端重新加载
+        self.shared = False             # 存储后端是否被多个进程共享，共享时使用内存中的会话前先确认没有被其它进程写入过
+        self.max_age = None             # 会话的绝对有效期，单位为秒，为空时不限制
+        self.idle_timeout = None        # 会话的闲置有效期，单位为秒，为空时不限制
+        self.touch_interval = 60        # 只读访问的会话至少间隔多少秒才把访问时间写回存储后端
+        self.sweep_interval = 60        # 清理存储后端中过期会话的间隔，单位为秒
+        self.sweep_batch = 500          # 每次最多清理的过期会话数量，避免一次清理占用过长时间
+        self.next_sweep = 0             # 下一次清理的时间
+        self.sweep_lock = threading.Lock()
+
+        self.evicted = 0                # 被淘汰出内存的会话数量
+        self.expired = 0                # 已过期的会话数量
+
+        # 分段会话锁，同一个会话的读写串行执行，不同会话之间互不阻塞
+        self.locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
 
-         # 会话本地存放目录
-        self.__storage_path__ = None
+        # 会话映射表的锁，只在操作映射表本身时短暂持有
+        self.map_lock = threading.Lock()
 
-     # 设置会话保存目录
+        # 已修改但尚未写入存储后端的会话，Session ID -> 未完成的写入次数，这些会话不会被淘汰出内存
+        self.pins = {}
+
+        # fork 出的子进程不负责写入父进程中尚未写入的会话
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    # fork 之后清空父进程中未完成的写入记录
+    def after_fork(self):
+        self.map_lock = threading.Lock()
+        self.pins = {}
+
+     # 设置会话保存目录，使用每个会话一个文件的存储后端
     def set_storage_path(self, path):
-        self.__storage_path__ = path
+        self.set_backend(FileBackend(path))
+
+    # 设置会话存储后端，background 为 True 时由后台线程写入，请求延迟中不再包含磁盘同步的时间
+    def set_backend(self, backend, background=False):
+        # 停止旧的后台写入线程
+        if self.writer is not None:
+            self.writer.stop()
+
+        self.backend = backend
+        self.writer = SessionWriter(backend, self.unpin) if background else None
+        self.cookie_store = None
+        self.__session_map__ = OrderedDict()
+        self.pins = {}
+
+    # 切换为签名 Cookie 会话，例如 use_signed_cookies(['new-key', 'old-key'], max_size=4093)
+    def use_signed_cookies(self, secret_keys, **options):
+        self.set_backend(None)
+        self.cookie_store = SignedCookieStore(secret_keys, **options)
+
+    # 修改会话配置，例如 configure(max_age=86400, idle_timeout=1800, max_sessions=50000)
+    def configure(self, **options):
+        for key, value in options.items():
+            if not hasattr(self, key):
+                raise AttributeError('Unknown session option: %s' % key)
+            setattr(self, key, value)
 
     # 单例模式，实现全局公用一个 Session 实例对象
     def __new__(cls, *args, **kwargs):
@@ -38,27 +545,175 @@ class Session:
             cls.__instance = super(Session, cls).__new__(cls, *args, **kwargs)
         return cls.__instance
 
-	# 保存会话记录到本地
+    # 获取会话对应的分段锁的下标
+    def stripe(self, session_id):
+        return hash(session_id) % LOCK_STRIPES
+
+    # 获取会话对应的分段锁
+    def lock(self, session_id):
+        return self.locks[self.stripe(session_id)]
+
+	# 保存会话记录到存储后端
     def storage(self, session_id):
-        # 构造 Session 会话的本地文件路径，文件名为 Session ID
-        session_path = os.path.join(self.__storage_path__, session_id)
+        # 如果已设置存储后端，则开始保存，没有 Session ID 的会话无法关联到客户端，不需要保存
+        if self.backend is not None and session_id:
+            with self.lock(session_id):
+                record = self.__session_map__.get(session_id)
+                if record is not None:
+                    self.backend.save(session_id, record.copy())
+
+    # 标记会话有一次尚未完成的写入
+    def pin(self, session_id):
+        with self.map_lock:
+            self.pins[session_id] = self.pins.get(session_id, 0) + 1
+
+    # 会话写入完成，没有未完成的写入时允许淘汰
+    def unpin(self, session_ids):
+        with self.map_lock:
+            for session_id in session_ids:
+                count = self.pins.get(session_id, 0) - 1
+                if count > 0:
+                    self.pins[session_id] = count
+                else:
+                    self.pins.pop(session_id, None)
+
+    # 选出可以淘汰的会话，需要持有映射表的锁
+    # 跳过正在加载的会话、尚未写入的会话，以及正被其它线程持有会话锁、可能正在修改的会话
+    def victim(self, loading):
+        for session_id in self.__session_map__:
+            if session_id == loading or session_id in self.pins:
+                continue
+
+            # 持有映射表的锁时不能阻塞等待会话锁，其它线程加载会话时会按相反的顺序加锁
+            lock = self.lock(session_id)
+            if lock.acquire(False):
+                # 释放之后其它线程拿到会话锁也要等映射表的锁，届时会话已被移出，会重新从存储后端加载
+                lock.release()
+                return session_id
+
+        return None
+
+    # 判断内存中的会话是否已被其它进程写入过
+    def is_stale(self, session_id, record):
+        if not self.shared or not session_id or self.backend is None or session_id in self.pins:
+            return False
+
+        stamp = self.backend.stamp(session_id)
+
+        # 文件修改时间以纳秒保存，与写入时的浮点数有微小的误差
+        return stamp is not None and abs(stamp - record.stored_accessed) > 1e-4
+
+    # 判断会话是否已过期
+    def is_expired(self, record, now):
+        if self.max_age is not None and now - record.created > self.max_age:
+            return True
+
+        if self.idle_timeout is not None and now - record.accessed > self.idle_timeout:
+            return True
+
+        return False
+
+    # 按需加载会话记录，第一次访问某个会话时才从存储后端读取，已过期的会话会被删除并重新创建
+    def load(self, session_id):
+        now = time.time()
+
+        # 持有会话锁，保证同一个会话只会从存储后端加载一次
+        with self.lock(session_id):
+            with self.map_lock:
+                record = self.__session_map__.get(session_id)
+                if record is not None:
+                    self.__session_map__.move_to_end(session_id)
+
+            # 多个进程共享存储后端时，内存中的会话可能已被其它进程修改，存储后端中的访问时间与本进程最后写入的不同时重新加载
+            # 本进程还有未写入的修改时以内存中的会话为准
+            if record is not None and self.is_stale(session_id, record):
+                with self.map_lock:
+                    self.__session_map__.pop(session_id, None)
+                record = None
+
+            if record is None:
+                # 没有 Session ID 或者没有存储后端时不需要读取，优先使用后台线程中尚未写入的记录
+                if session_id and self.writer is not None:
+                    record = self.writer.get(session_id)
+
+                if record is None and session_id and self.backend is not None:
+                    record = self.backend.load(session_id)
+
+            # 过期的会话从存储后端删除
+            if record is not None and self.is_expired(record, now):
+                with self.map_lock:
+                    self.expired += 1
+                    self.__session_map__.pop(session_id, None)
+
+                if session_id and self.backend is not None:
+                    self.backend.delete(session_id)
+
+                record = None
+
+            if record is None:
+                record = SessionRecord(created=now, accessed=now)
+
+            with self.map_lock:
+                if session_id not in self.__session_map__:
+                    self.__session_map__[session_id] = record
+
+                    # 超出容量时淘汰最久未访问且已写入存储后端的会话，下次访问时重新加载
+                    # 全部会话都还在使用中时暂时超出容量，等写入完成后的下一次加载再淘汰
+                    while len(self.__session_map__) > self.max_sessions:
+                        victim = self.victim(session_id)
+                        if victim is None:
+                            break
+
+                        del self.__session_map__[victim]
+                        self.evicted += 1
+
+            # 更新访问时间
+            record.accessed = now
+            return record
+
+    # 从请求的 Cookie 中解码会话记录，同一个请求只解码一次
+    def load_cookie(self, request):
+        record = request.environ.get(COOKIE_KEY)
+
+        if record is None:
+            now = time.time()
+            value = request.cookies.get(self.cookie_store.cookie_name)
+            record = self.cookie_store.loads(value) if value else None
+
+            # 已过期的会话重新创建
+            if record is not None and self.is_expired(record, now):
+                with self.map_lock:
+                    self.expired += 1
+                record = None
 
-        # 如果已设置 Session 会话存放路径，则开始缓存到本地
-        if self.__storage_path__ is not None:
-            with open(session_path, 'wb') as f:
-                # 将会话记录序列化为字符串
-                content = json.dumps(self.__session_map__[session_id])
+            if record is None:
+                record = SessionRecord(created=now, accessed=now)
 
-                # 进行 base64 编码再写入文件中，防止一些特定二进制数据无法正确写入
-                f.write(base64.encodebytes(content.encode()))
+            record.accessed = now
+            request.environ[COOKIE_KEY] = record
+
+        return record
+
+    # 获取当前请求的会话记录，只读访问间隔较久时同样标记为待写入，以便把访问时间写回存储后端
+    def record(self, request):
+        session_id = get_session_id(request)
+        record = self.load_cookie(request) if self.cookie_store is not None else self.load(session_id)
+
+        if self.idle_timeout is not None and record.accessed - record.stored_accessed > self.touch_interval:
+            self.mark(request, session_id, record)
+
+        return record
 
     # 获取当前会话记录
     def map(self, request):
-        return self.__session_map__.get(get_session_id(request), {})
+        return self.record(request).data
 
     # 获取当前会话的某个项
     def get(self, request, item):
-        return self.__session_map__.get(get_session_id(request), {}).get(item, None)
+        session_id = get_session_id(request)
+
+        with self.lock(session_id):
+            return self.record(request).data.get(item, None)
 
     # 更新或添加记录
     def push(self, request, item, value):
@@ -66,58 +721,185 @@ class Session:
         # 从请求中获取客户端的 Session ID
         session_id = get_session_id(request)
 
-        # 如果这个 Session ID 已存在与映射表中，则直接为其添加新的数据键值对，如果不存在，则先初始化为空的字典，再添加数据键值对
-        if session_id in self.__session_map__:
-            # 直接对当前会话添加数据
-            self.__session_map__[session_id][item] = value
-        else:
-            # 初始化当前会话
-            self.__session_map__[session_id] = {}
-
-            # 对当前会话添加数据
-            self.__session_map__[session_id][item] = value
-
-        # 会话发生变化，更新缓存到本地
-        self.storage(session_id)
+        with self.lock(session_id):
+            # 获取当前会话，会话不存在时会初始化为空的会话
+            record = self.record(request)
+
+            # 对当前会话添加数据，Cookie 会话超出大小限制时撤销修改并抛出异常
+            if self.cookie_store is not None:
+                missing = object()
+                old = record.data.get(item, missing)
+                record.data[item] = value
+
+                try:
+                    self.cookie_store.check(record)
+                except exceptions.SessionTooLargeError:
+                    if old is missing:
+                        record.data.pop(item)
+                    else:
+                        record.data[item] = old
+                    raise
+            else:
+                record.data[item] = value
+
+            # 会话发生变化，标记为待写入
+            self.mark(request, session_id, record)
 
     # 删除当前会话的某个项
     def pop(self, request, item, value=True):
 
         # 获取当前会话
         session_id = get_session_id(request)
-        current_session = self.__session_map__.get(session_id, {})
 
-        # 判断数据项的键是否存在于当前的会话中，如果存在则删除
-        if item in current_session:
-            current_session.pop(item, value)
+        with self.lock(session_id):
+            record = self.record(request)
+
+            # 判断数据项的键是否存在于当前的会话中，如果存在则删除
+            if item in record.data:
+                record.data.pop(item, value)
+
+            # 会话发生变化，标记为待写入
+            self.mark(request, session_id, record)
 
-        # 会话发生变化，更新缓存到本地
-        self.storage(session_id)
+    # 标记本次请求修改过的会话，请求结束后由 flush 统一写入一次
+    def mark(self, request, session_id, record):
+        environ = getattr(request, 'environ', None)
 
-    # 加载本地会话记录
-    def load_local_session(self):
+        # 不在请求周期内时立即写入
+        if environ is None:
+            self.storage(session_id)
+            return
+
+        # 记录会话本身而不是只记录 Session ID，同一个请求内第一次修改时标记为尚未写入，写入之前不会被淘汰出内存
+        dirty = environ.setdefault(DIRTY_KEY, {})
+        if session_id not in dirty and session_id and self.backend is not None:
+            self.pin(session_id)
+        dirty[session_id] = record
 
-        # 如果已设置 Session 会话存放路径，则开始从本地加载缓存
-        if self.__storage_path__ is not None:
+    # 丢弃本次请求对会话的修改标记，请求处理失败、不再调用 flush 时使用，避免会话一直不能被淘汰
+    def discard(self, request):
+        dirty = request.environ.pop(DIRTY_KEY, None)
 
-            # 从本地存放目录获取所有 Session 会话记录文件列表，文件名其实就是 Session ID
-            session_path_list = os.listdir(self.__storage_path__)
+        if dirty and self.cookie_store is None:
+            self.unpin([session_id for session_id in dirty if session_id])
 
-            # 遍历会话记录文件列表
-            for session_id in session_path_list:
+    # 把本次请求修改过的会话一次性写入存储后端，在响应生成之后调用
+    # 返回需要追加到响应中的报头列表，只有 Cookie 会话会用到
+    def flush(self, request):
+        dirty = request.environ.pop(DIRTY_KEY, None)
 
-                # 构造会话记录文件目录
-                path = os.path.join(self.__storage_path__, session_id)
+        # Cookie 会话只需要把最新的会话写回 Cookie
+        if self.cookie_store is not None:
+            record = request.environ.get(COOKIE_KEY)
 
-                # 读取文件中的内容
-                with open(path, 'rb') as f:
-                    content = f.read()
+            if not dirty or record is None:
+                return []
+
+            # 超出大小限制时（例如通过 map 直接修改了会话）不发送新的 Cookie，客户端保留原来的会话，不让响应变成 500
+            value = self.cookie_store.dumps(record)
+            header = self.cookie_store.header(value, self.max_age)
+
+            if len(header) > self.cookie_store.max_size:
+                logger.warning('Session cookie too large (%d bytes), changes dropped', len(header))
+                return []
+
+            return [('Set-Cookie', header)]
+
+        # 顺带清理过期的会话
+        self.maybe_sweep()
+
+        # 没有修改或者没有存储后端时不需要写入
+        if not dirty or self.backend is None:
+            if dirty:
+                self.unpin([session_id for session_id in dirty if session_id])
+            return []
+
+        dirty = [(session_id, record) for session_id, record in dirty.items() if session_id]
+
+        if not dirty:
+            return []
+
+        # 按下标顺序获取涉及的分段锁，避免多个请求交叉加锁造成死锁
+        locks = [self.locks[index] for index in sorted(set(self.stripe(session_id) for session_id, _ in dirty))]
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            # 持有锁时复制会话，其它线程不会在复制或写入的过程中修改会话
+            items = []
+            for session_id, record in dirty:
+                record.stored_accessed = record.accessed
+                items.append((session_id, record.copy()))
+
+            # 后台写入时只在锁内提交，同一会话的提交顺序与修改顺序一致，写入完成后由后台线程解除标记
+            if self.writer is not None:
+                self.writer.submit(items)
+            else:
+                try:
+                    self.backend.save_many(items)
+                finally:
+                    self.unpin([session_id for session_id, _ in items])
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        return []
+
+    # 是否到达清理过期会话的时间
+    def sweep_due(self, now=None):
+        if self.backend is None or (self.max_age is None and self.idle_timeout is None):
+            return False
+
+        return (now or time.time()) >= self.next_sweep
+
+    # 到达清理间隔时分批清理存储后端中的过期会话，同一时间只有一个请求负责清理
+    def maybe_sweep(self):
+        now = time.time()
+
+        if not self.sweep_due(now):
+            return
+
+        if not self.sweep_lock.acquire(False):
+            return
+
+        try:
+            self.next_sweep = now + self.sweep_interval
+            self.sweep(now)
+        finally:
+            self.sweep_lock.release()
+
+    # 清理一批过期的会话，返回清理的数量
+    def sweep(self, now=None):
+        now = now or time.time()
+
+        # 转换为存储后端按时间比较的条件，未设置的有效期不参与比较
+        created_before = now - self.max_age if self.max_age is not None else 0
+        accessed_before = now - self.idle_timeout if self.idle_timeout is not None else 0
+
+        count = self.backend.sweep(created_before, accessed_before, self.sweep_batch)
+
+        with self.map_lock:
+            self.expired += count
+
+        return count
+
+    # 会话统计信息
+    def stats(self):
+        return {
+            'live': len(self.__session_map__),
+            'evicted': self.evicted,
+            'expired': self.expired
+        }
+
+    # 一次性加载存储后端中的全部会话记录，会话默认按需加载，通常不需要调用
+    def load_local_session(self):
 
-                # 把文件内容进行 base64 解码
-                content = base64.decodebytes(content)
+        # 如果已设置存储后端，则开始加载
+        if self.backend is not None:
 
-                # 把 Session ID 于对应的会话内容绑定添加到会话映射表中
-                self.__session_map__[session_id] = json.loads(content.decode())
+            # 遍历全部 Session ID
+            for session_id in self.backend.keys():
+                self.load(session_id)
 
 # 单例全局对象
 session = Session()
@@ -0,0 +1,472 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timezone
+from collections import OrderedDict
+from werkzeug.wrappers import Response
+from werkzeug.http import http_date, parse_date, is_resource_modified
+
+
+# 流式读取文件时每次读取的字节数
+CHUNK_SIZE = 64 * 1024
+
+# 一个请求最多允许的 Range 区间数量，超出时忽略 Range 返回完整文件
+MAX_RANGES = 16
+
+# 只缓存元信息的缓存项所占用的名义字节数，避免大文件的元信息无限堆积
+META_COST = 256
+
+# 记录不存在的文件的最大数量，超出时清空重新记录
+MAX_MISSING = 10000
+
+# 带指纹的静态资源的缓存策略，文件内容变化时 URL 也会变化，所以可以永久缓存
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+# 静态资源缓存项，content 为空时表示文件过大，只缓存元信息，内容需要从磁盘流式读取
+class StaticEntry:
+    def __init__(self, path, mtime, size, content=None):
+        self.path = path                # 资源文件路径
+        self.content = content          # 资源文件内容
+        self.mtime = mtime              # 文件修改时间，用于判断缓存是否失效
+        self.size = size                # 文件大小，用于判断缓存是否失效
+        self.checked_at = time.time()   # 最近一次检查文件状态的时间
+        self.variants = {}              # 编码 -> 压缩后的缓存项
+
+        # 缓存占用的字节数
+        self.cost = len(content) if content is not None else META_COST
+
+        # 以文件内容的摘要作为强校验的 ETag，大文件则以修改时间与大小生成，避免为此读取整个文件
+        if content is not None:
+            self.etag = hashlib.sha1(content).hexdigest()
+        else:
+            self.etag = '%x-%x' % (int(mtime * 1000000), size)
+
+        # 格式化最后修改时间，作为 Last-Modified 报头，HTTP 日期只精确到秒
+        self.modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+        self.last_modified = http_date(self.modified)
+
+    # 缓存校验报头
+    def headers(self):
+        return {
+            'ETag': '"%s"' % self.etag,
+            'Last-Modified': self.last_modified
+        }
+
+    # 根据请求的 If-None-Match 与 If-Modified-Since 判断客户端缓存是否依然有效
+    def not_modified(self, environ):
+        return not is_resource_modified(environ, etag=self.etag, last_modified=self.modified)
+
+    # 判断 If-Range 条件是否成立，不成立时应忽略 Range 返回完整文件
+    def if_range(self, environ):
+        value = environ.get('HTTP_IF_RANGE')
+
+        # 没有 If-Range 报头时条件总是成立
+        if not value:
+            return True
+
+        # If-Range 为 ETag 时只做强比较
+        if value.startswith('"'):
+            return value == '"%s"' % self.etag
+
+        # If-Range 为日期时与最后修改时间比较
+        return parse_date(value) == self.modified
+
+
+# 静态资源内存缓存，按字节数限制容量，超出时淘汰最久未使用的资源
+class StaticCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=1024 * 1024, check_interval=1.0):
+        self.max_bytes = max_bytes                  # 缓存占用的最大字节数
+        self.max_entry_bytes = max_entry_bytes      # 单个文件可缓存的最大字节数，更大的文件不进入缓存
+        self.check_interval = check_interval        # 两次检查文件状态的最小间隔，间隔内直接使用缓存，不访问磁盘
+        self.entries = OrderedDict()                # 资源路径 -> 缓存项，按使用顺序排列
+        self.bytes = 0                              # 当前缓存占用的字节数
+        self.hits = 0                               # 命中次数
+        self.misses = 0                             # 未命中次数
+        self.evictions = 0                          # 淘汰次数
+        self.missing = {}                           # 不存在的文件路径 -> 检查时间，避免频繁访问磁盘
+        self.lock = threading.Lock()
+
+    # 获取资源文件的缓存项，文件不存在时返回 None
+    def get(self, path):
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(path)
+
+            # 在检查间隔内命中，直接返回缓存，不访问磁盘
+            if entry is not None and now - entry.checked_at < self.check_interval:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+
+            # 在检查间隔内已确认文件不存在，直接返回
+            if entry is None and now - self.missing.get(path, 0) < self.check_interval:
+                return None
+
+        # 获取文件状态，文件不存在时移除缓存并记录下来
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self.lock:
+                self._remove(path)
+
+                if len(self.missing) >= MAX_MISSING:
+                    self.missing.clear()
+                self.missing[path] = now
+            return None
+
+        # 文件的修改时间与大小都没有变化，缓存依然有效
+        if entry is not None and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+            with self.lock:
+                entry.checked_at = now
+                self.entries.move_to_end(path)
+                self.hits += 1
+            return entry
+
+        # 缓存未命中或已失效，重新读取文件内容，过大的文件只记录元信息，发送时再从磁盘流式读取
+        content = None
+        if stat.st_size <= self.max_entry_bytes:
+            try:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except IOError:
+                self.discard(path)
+                return None
+
+        entry = StaticEntry(path, stat.st_mtime, stat.st_size, content)
+
+        with self.lock:
+            self.misses += 1
+
+            # 替换旧的缓存
+            self._remove(path)
+            self.missing.pop(path, None)
+            self.entries[path] = entry
+            self.bytes += entry.cost
+            self._evict()
+
+        return entry
+
+    # 获取缓存项的编码版本，第一次使用时调用 encode 生成，并随缓存项一起缓存，文件变化时随缓存项一起失效
+    def variant(self, entry, encoding, encode):
+        variant = entry.variants.get(encoding)
+
+        if variant is None:
+            data = encode(entry.content)
+            variant = StaticEntry(entry.path, entry.mtime, len(data), data)
+
+            with self.lock:
+                entry.variants[encoding] = variant
+
+                # 缓存项仍在缓存中时，把编码版本占用的字节数计入缓存容量
+                if self.entries.get(entry.path) is entry:
+                    entry.cost += variant.cost
+                    self.bytes += variant.cost
+                    self._evict()
+
+        return variant
+
+    # 移除某个资源的缓存
+    def discard(self, path):
+        with self.lock:
+            self._remove(path)
+
+    # 清空缓存
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.missing.clear()
+            self.bytes = 0
+
+    # 缓存统计信息
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes
+        }
+
+    # 超出容量时淘汰最久未使用的资源，调用方需持有锁
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.entries:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.cost
+            self.evictions += 1
+
+    # 移除缓存项并扣除占用的字节数，调用方需持有锁
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry.cost
+
+
+# 读取文件的元信息并生成不含内容的缓存项，文件不存在时返回 None
+def stat_entry(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return StaticEntry(path, stat.st_mtime, stat.st_size)
+
+
+# 解析 Range 报头，返回 [(起始位置, 结束位置)] 列表，结束位置不包含在内
+# 报头不存在或格式不合法时返回 None，表示应返回完整文件；所有区间都超出文件范围时返回空列表
+def parse_ranges(value, length):
+    if not value or not value.startswith('bytes='):
+        return None
+
+    ranges = []
+
+    for item in value[6:].split(','):
+        start, sep, stop = item.strip().partition('-')
+
+        if not sep:
+            return None
+
+        try:
+            if not start:
+                # 后缀区间，表示文件的最后 N 个字节
+                suffix = int(stop)
+                start, stop = max(length - suffix, 0), length
+            else:
+                start = int(start)
+
+                if stop:
+                    stop = int(stop) + 1
+
+                    # 结束位置小于起始位置，格式不合法
+                    if stop <= start:
+                        return None
+                else:
+                    # 没有结束位置，表示一直到文件末尾
+                    stop = length
+        except ValueError:
+            return None
+
+        # 截断超出文件长度的部分，完全超出的区间直接丢弃
+        stop = min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+
+    # 区间过多时忽略 Range，防止被用来放大请求
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    return ranges
+
+
+# 从文件中流式读取指定区间的内容，读取完毕后关闭文件
+def iter_file(f, start, length, chunk_size=CHUNK_SIZE):
+    try:
+        f.seek(start)
+
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+
+            if not data:
+                break
+
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+# 文件响应体，在交给 WSGI 服务器时才根据请求处理条件请求与 Range，并以文件句柄流式发送内容
+# 完整文件优先使用服务器提供的 wsgi.file_wrapper（通常基于 sendfile 实现零拷贝），否则分块读取
+class FileResponse(Response):
+    def __init__(self, entry, content_type=None, headers=None, chunk_size=CHUNK_SIZE):
+        super(FileResponse, self).__init__(content_type=content_type, headers=headers)
+        self.entry = entry                  # 文件缓存项，带有校验信息，可能带有文件内容
+        self.chunk_size = chunk_size        # 每次读取的字节数
+        self.direct_passthrough = True      # 响应内容直接交给服务器，不经过 werkzeug 的编码处理
+
+        # 写入缓存校验报头，并声明支持 Range 请求
+        self.headers.update(entry.headers())
+        self.headers['Accept-Ranges'] = 'bytes'
+
+    # 生成最终的 WSGI 响应
+    def get_wsgi_response(self, environ):
+        entry = self.entry
+
+        # 客户端缓存依然有效时返回 304，不需要重新发送文件内容
+        if entry.not_modified(environ):
+            self.status_code = 304
+            self.response = []
+            return super(FileResponse, self).get_wsgi_response(environ)
+
+        # 解析 Range 报头，If-Range 条件不成立时忽略 Range
+        ranges = parse_ranges(environ.get('HTTP_RANGE'), entry.size) if entry.if_range(environ) else None
+
+        if ranges is not None and not ranges:
+            # 所有区间都超出文件范围，返回 416
+            self.status_code = 416
+            self.response = []
+            self.headers['Content-Range'] = 'bytes */%d' % entry.size
+            self.headers['Content-Length'] = '0'
+        elif ranges is not None and len(ranges) == 1:
+            # 单个区间，返回 206 与对应的内容
+            start, stop = ranges[0]
+            self.status_code = 206
+            self.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, entry.size)
+            self.headers['Content-Length'] = str(stop - start)
+            self.response = self.iter_range(environ, start, stop)
+        elif ranges:
+            # 多个区间，以 multipart/byteranges 格式返回
+            self.status_code = 206
+            self.response = self.iter_multipart(environ, ranges)
+        else:
+            # 返回完整文件
+            self.headers['Content-Length'] = str(entry.size)
+            self.response = self.iter_range(environ, 0, entry.size)
+
+        return super(FileResponse, self).get_wsgi_response(environ)
+
+    # 生成指定区间的响应内容
+    def iter_range(self, environ, start, stop):
+        # HEAD 请求不需要读取文件
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+
+        # 已缓存文件内容时直接返回内存中的数据
+        if self.entry.content is not None:
+            return [self.entry.content[start:stop]]
+
+        f = open(self.entry.path, 'rb')
+
+        # 完整文件交给服务器的 wsgi.file_wrapper 发送
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and start == 0 and stop == self.entry.size:
+            return file_wrapper(f, self.chunk_size)
+
+        return iter_file(f, start, stop - start, self.chunk_size)
+
+    # 生成 multipart/byteranges 格式的响应内容
+    def iter_multipart(self, environ, ranges):
+        boundary = uuid.uuid4().hex
+        content_type = self.headers.get('Content-Type', 'application/octet-stream')
+
+        # 预先计算每个分段的头部，以便得出完整的 Content-Length
+        parts = []
+        length = 0
+        for start, stop in ranges:
+            head = ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, content_type, start, stop - 1, self.entry.size)).encode('latin-1')
+            parts.append((head, start, stop))
+            length += len(head) + (stop - start) + 2
+
+        tail = ('--%s--\r\n' % boundary).encode('latin-1')
+        length += len(tail)
+
+        self.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        self.headers['Content-Length'] = str(length)
+
+        # HEAD 请求不需要读取文件
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+
+        return self.iter_parts(parts, tail)
+
+    # 依次读取每个分段的内容
+    def iter_parts(self, parts, tail):
+        content = self.entry.content
+        f = open(self.entry.path, 'rb') if content is None else None
+
+        try:
+            for head, start, stop in parts:
+                yield head
+
+                if content is not None:
+                    yield content[start:stop]
+                else:
+                    f.seek(start)
+                    length = stop - start
+                    while length > 0:
+                        data = f.read(min(self.chunk_size, length))
+                        if not data:
+                            break
+                        length -= len(data)
+                        yield data
+
+                yield b'\r\n'
+
+            yield tail
+        finally:
+            if f is not None:
+                f.close()
+
+
+# 计算文件内容的摘要
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+# 在文件名的后缀前插入指纹，例如 css/app.css -> css/app.3f9a1c8e.css
+def fingerprint_name(name, digest):
+    head, sep, tail = name.rpartition('/')
+    base, dot, ext = tail.rpartition('.')
+
+    # 没有后缀或以 “.” 开头的文件直接在末尾追加指纹
+    if not base:
+        tail = '%s.%s' % (tail, digest)
+    else:
+        tail = '%s.%s.%s' % (base, digest, ext)
+
+    return head + sep + tail
+
+
+# 静态资源指纹清单，启动时遍历静态资源目录计算一次，请求期只做字典查找
+class AssetManifest:
+    def __init__(self, hash_length=8):
+        self.hash_length = hash_length  # 指纹长度
+        self.prefix = '/static/'        # 静态资源的 URL 前缀
+        self.assets = {}                # 逻辑名 -> 带指纹的文件名，例如 css/app.css -> css/app.3f9a1c8e.css
+        self.files = {}                 # 带指纹的资源路径 -> 实际文件路径，均包含静态资源目录
+
+    # 遍历静态资源目录，为每个文件计算指纹
+    def build(self, folder):
+        folder = folder.strip('/')
+        assets = {}
+        files = {}
+
+        for root, dirs, names in os.walk(folder):
+            # 跳过隐藏目录与隐藏文件
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+
+            for name in names:
+                if name.startswith('.'):
+                    continue
+
+                path = os.path.join(root, name)
+
+                # 逻辑名为相对静态资源目录的路径，统一以 “/” 分隔
+                logical = os.path.relpath(path, folder).replace(os.sep, '/')
+                hashed = fingerprint_name(logical, file_digest(path)[:self.hash_length])
+
+                assets[logical] = hashed
+                files['%s/%s' % (folder, hashed)] = '%s/%s' % (folder, logical)
+
+        self.prefix = '/%s/' % folder
+        self.assets = assets
+        self.files = files
+
+    # 获取资源的带指纹 URL，清单中没有的资源返回原始 URL
+    def url(self, name):
+        name = name.strip().lstrip('/')
+        return self.prefix + self.assets.get(name, name)
+
+    # 把带指纹的资源路径还原为实际文件路径，不是带指纹的路径时返回 None
+    def resolve(self, path):
+        return self.files.get(path)
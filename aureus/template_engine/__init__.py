@@ -1,48 +1,359 @@
 import os
 import re
+import time
+import threading
+from collections import OrderedDict
+import aureus.exceptions as exceptions
 
 
 # 模版标记
 pattern = r'{{(.*?)}}'
 
+# 预编译的模版标记正则
+comp = re.compile(pattern)
+
+# 静态资源标记的前缀
+asset_prefix = 'asset:'
+
+# 找不到本地模版文件时返回的内容
+NOT_FOUND = '<h1>Not Found Template</h1>'
+
+# 流式渲染时缓冲区超过该字符数就立即输出
+STREAM_BUFFER_SIZE = 8192
+
+# 模版片段类型
+LITERAL = 0     # 原样输出的文本
+VARIABLE = 1    # 置换数据标记，例如 {{ name }}
+ASSET = 2       # 静态资源标记，例如 {{ asset:css/app.css }}
+CACHE = 3       # 片段缓存区块，例如 {% cache sidebar user_id ttl=60 %} ... {% endcache %}
+
+# 模版标记与区块标签
+token_comp = re.compile(r'{{(.*?)}}|{%\s*(cache\b.*?|endcache)\s*%}')
+
 # 解析模版
 def parse_args(obj):
-    # 获取匹配对象
-    comp = re.compile(pattern)
-
     # 查找所有匹配的结果
     ret = comp.findall(obj)
 
     # 如果匹配结果不为空，返回它，为空则返回一个空的 tuple
     return ret if ret else ()
 
+# 解析片段缓存标签，返回 (区块名, 键变量列表, 有效期)，有效期未指定时为 None
+def parse_cache_tag(tag):
+    args = tag.split()[1:]
+
+    # 必须指定区块名
+    if not args:
+        raise exceptions.TemplateSyntaxError('Cache tag requires a name')
+
+    ttl = None
+    keys = []
+    for arg in args[1:]:
+        if arg.startswith('ttl='):
+            try:
+                ttl = float(arg[4:])
+            except ValueError:
+                raise exceptions.TemplateSyntaxError('Invalid cache ttl: %s' % arg)
+        else:
+            keys.append(arg)
+
+    return args[0], tuple(keys), ttl
+
+# 把模版内容编译为片段列表，每个片段为 (类型, 值, 原始标记)，片段缓存区块的第三项为区块内的片段列表
+def compile_template(content):
+    segments = []
+    stack = []
+    pos = 0
+
+    for match in token_comp.finditer(content):
+        # 标记之前的文本
+        if match.start() > pos:
+            segments.append((LITERAL, content[pos:match.start()], None))
+
+        pos = match.end()
+
+        # 区块标签
+        tag = match.group(2)
+        if tag is not None:
+            if tag == 'endcache':
+                # 没有对应开始标签的结束标签
+                if not stack:
+                    raise exceptions.TemplateSyntaxError('Unexpected endcache tag')
+
+                # 区块结束，回到外层片段列表
+                parent, options = stack.pop()
+                parent.append((CACHE, options, segments))
+                segments = parent
+            else:
+                # 区块开始，之后的片段写入区块自己的片段列表
+                stack.append((segments, parse_cache_tag(tag)))
+                segments = []
+            continue
+
+        # 从标记中获取键
+        key = match.group(1).strip()
+
+        if key.startswith(asset_prefix):
+            segments.append((ASSET, key[len(asset_prefix):], match.group(0)))
+        else:
+            segments.append((VARIABLE, key, match.group(0)))
+
+    # 最后一个标记之后的文本
+    if pos < len(content):
+        segments.append((LITERAL, content[pos:], None))
+
+    # 有未结束的区块
+    if stack:
+        raise exceptions.TemplateSyntaxError('Unclosed cache tag')
+
+    return segments
+
+# 判断置换数据是否为需要逐块输出的可迭代对象，字符串、字典等普通数据不算
+def is_stream(data):
+    return hasattr(data, '__iter__') and not isinstance(data, (str, bytes, dict, list, tuple, set))
+
+# 模版片段缓存，按 区块名 + 键 缓存渲染结果，可以跨请求、跨模版复用
+class FragmentCache:
+    def __init__(self, max_entries=1024, default_ttl=300):
+        self.max_entries = max_entries      # 最多缓存的片段数量，超出时淘汰最久未使用的片段
+        self.default_ttl = default_ttl      # 默认有效期，单位为秒
+        self.entries = OrderedDict()        # (区块名, 键...) -> (过期时间, 渲染结果)
+        self.hits = 0                       # 命中次数
+        self.misses = 0                     # 未命中次数
+        self.evictions = 0                  # 淘汰次数
+        self.lock = threading.Lock()
+
+    # 获取片段，不存在或已过期时返回 None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            # 移除过期的片段
+            if entry is not None:
+                del self.entries[key]
+
+            self.misses += 1
+            return None
+
+    # 缓存片段
+    def set(self, key, content, ttl=None):
+        expires = time.time() + (self.default_ttl if ttl is None else ttl)
+
+        with self.lock:
+            self.entries[key] = (expires, content)
+            self.entries.move_to_end(key)
+
+            # 超出容量时淘汰最久未使用的片段
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # 使片段失效，只传区块名时使该区块所有键的片段失效，例如 invalidate('sidebar', 42)
+    def invalidate(self, name, *keys):
+        with self.lock:
+            if keys:
+                self.entries.pop((name,) + tuple(str(key) for key in keys), None)
+                return
+
+            for key in [key for key in self.entries if key[0] == name]:
+                del self.entries[key]
+
+    # 清空缓存
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # 缓存统计信息
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# 全局片段缓存
+fragment_cache = FragmentCache()
+
+# 渲染片段列表，结果追加到 parts 中
+def render_segments(segments, app, options, parts):
+    for kind, value, raw in segments:
+        if kind == LITERAL:
+            parts.append(value)
+        elif kind == ASSET:
+            # 静态资源标记替换为带指纹的 URL
+            parts.append(app.asset_manifest.url(value))
+        elif kind == CACHE:
+            # 片段缓存区块
+            parts.append(render_fragment(value, raw, app, options))
+        elif options:
+            # 如果置换内容不为空，且键存在于置换数据中，则进行数据替换，反之替换为空
+            data = options.get(value, '')
+
+            # 延迟计算的数据在这里求值
+            if callable(data):
+                data = data()
+
+            parts.append(''.join(str(chunk) for chunk in data) if is_stream(data) else str(data))
+        else:
+            # 没有置换内容时保留原始标记
+            parts.append(raw)
+
+# 渲染片段缓存区块，命中缓存时不再渲染区块内容
+def render_fragment(tag, segments, app, options):
+    name, keys, ttl = tag
+
+    # 缓存键由区块名与键变量的值组成
+    key = (name,) + tuple(str(options.get(k, '')) for k in keys)
+
+    content = fragment_cache.get(key)
+    if content is None:
+        parts = []
+        render_segments(segments, app, options, parts)
+        content = ''.join(parts)
+        fragment_cache.set(key, content, ttl)
+
+    return content
+
+# 编译后的模版
+class Template:
+    def __init__(self, path, mtime, content):
+        self.path = path                            # 模版文件路径
+        self.mtime = mtime                          # 编译时模版文件的修改时间
+        self.segments = compile_template(content)   # 编译后的片段列表
+
+    # 渲染模版，一次拼接得到完整内容
+    def render(self, app, options):
+        parts = []
+        render_segments(self.segments, app, options, parts)
+        return ''.join(parts)
+
+    # 流式渲染模版，返回编码后的分块生成器
+    # 置换数据为函数或生成器时会延迟到输出位置才计算，计算前先把已渲染的内容输出，让页面头部尽早到达客户端
+    def stream(self, app, options, encoding='utf-8'):
+        buffer = []
+        size = 0
+
+        for kind, value, raw in self.segments:
+            if kind == LITERAL:
+                data = value
+            elif kind == ASSET:
+                data = app.asset_manifest.url(value)
+            elif kind == CACHE:
+                data = render_fragment(value, raw, app, options)
+            elif options:
+                data = options.get(value, '')
+
+                # 遇到需要延迟计算的数据，先输出缓冲区中的内容
+                if callable(data) or is_stream(data):
+                    if buffer:
+                        yield ''.join(buffer).encode(encoding)
+                        buffer, size = [], 0
+
+                    if callable(data):
+                        data = data()
+
+                    # 生成器的每个分块直接输出，不在内存中拼接
+                    if is_stream(data):
+                        for chunk in data:
+                            yield str(chunk).encode(encoding)
+                        continue
+
+                data = str(data)
+            else:
+                data = raw
+
+            buffer.append(data)
+            size += len(data)
+
+            # 缓冲区过大时立即输出，限制单个请求占用的内存
+            if size >= STREAM_BUFFER_SIZE:
+                yield ''.join(buffer).encode(encoding)
+                buffer, size = [], 0
+
+        if buffer:
+            yield ''.join(buffer).encode(encoding)
+
+# 模版缓存，按文件路径缓存编译后的模版，只有文件修改时间变化时才重新编译
+class TemplateCache:
+    def __init__(self):
+        self.templates = {}             # 模版文件路径 -> 编译后的模版
+        self.lock = threading.Lock()
+
+    # 获取编译后的模版，文件不存在时返回 None
+    def get(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.templates.pop(path, None)
+            return None
+
+        template = self.templates.get(path)
+
+        # 修改时间没有变化，直接使用缓存
+        if template is not None and template.mtime == mtime:
+            return template
+
+        # 获取模版文件内容并编译
+        with open(path, 'rb') as f:
+            template = Template(path, mtime, f.read().decode())
+
+        with self.lock:
+            self.templates[path] = template
+
+        return template
+
+    # 预编译模版目录中的全部模版，避免第一次请求时才编译
+    def precompile(self, folder):
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                # 跳过无法按文本解码的文件
+                try:
+                    self.get(os.path.join(root, name))
+                except UnicodeDecodeError:
+                    continue
+
+    # 清空缓存
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+# 全局模版缓存
+template_cache = TemplateCache()
+
 # 返回模版内容
 def replace_template(app, path, **options):
-    # 默认返回内容，当找不到本地模版文件时返回
-    content = '<h1>Not Found Template</h1>'
-
     # 获取模版文件本地路径
     path = os.path.join(app.template_folder, path)
 
-    # 如果路径存在，则开始解析置换
-    if os.path.exists(path):
+    # 从缓存中获取编译后的模版
+    template = template_cache.get(path)
 
-        # 获取模版文件内容
-        with open(path, 'rb') as f:
-            content = f.read().decode()
+    # 当找不到本地模版文件时返回默认内容
+    if template is None:
+        return NOT_FOUND
+
+    # 返回模版内容
+    return template.render(app, options)
 
-        # 解析出所有的标记
-        args = parse_args(content)
+# 流式返回模版内容，返回编码后的分块生成器
+def stream_template(app, path, **options):
+    # 获取模版文件本地路径
+    path = os.path.join(app.template_folder, path)
 
-        # 如果置换内容不为空，开始置换
-        if options:
-            # 遍历所有置换数据，开始置换
-            for arg in args:
-                # 从标记中获取键
-                key = arg.strip()
+    # 从缓存中获取编译后的模版
+    template = template_cache.get(path)
 
-                # 如果键存在于置换数据中，则进行数据替换，反之替换为空
-                content = content.replace("{{%s}}" % arg, str(options.get(key, '')))
+    # 当找不到本地模版文件时返回默认内容
+    if template is None:
+        return iter([NOT_FOUND.encode()])
 
-    # 返回模版内容
-    return content
\ No newline at end of file
+    # 返回分块生成器
+    return template.stream(app, options)
@@ -1,3 +1,9 @@
+import inspect
+
+
+# 视图中按请求方法命名的处理函数
+HANDLER_NAMES = ('get', 'post', 'put', 'patch', 'delete', 'head', 'options')
+
 # 视图基类
 class View:
     # 支持的请求方法
@@ -10,6 +16,11 @@ class View:
     def dispatch_request(self, request, *args, **option):
         raise NotImplementedError
 
+    # 判断视图是否为异步视图，调度入口或任一请求方法处理函数为 async def 时视为异步视图
+    @classmethod
+    def is_async(cls):
+        return any(inspect.iscoroutinefunction(getattr(cls, name, None)) for name in ('dispatch_request',) + HANDLER_NAMES)
+
     # 生成视图处理函数，参数 name 其实就是节点名
     @classmethod
     def get_func(cls, name):
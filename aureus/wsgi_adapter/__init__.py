@@ -1,4 +1,7 @@
 from werkzeug.wrappers import Request
+from aureus.session import session
+from aureus.profiler import profiler
+from aureus.metrics import metrics, endpoint_of
 
 # WSGI 调度框架入口
 def wsgi_app(app, environ, start_response):
@@ -11,9 +14,49 @@ def wsgi_app(app, environ, start_response):
   # 解析请求头
   request = Request(environ)
 
-  # 把请求传给框架的路由进行处理，并获取处理结果
-  response = app.dispatch_request(request)
+  # 开始记录本次请求的指标
+  scope = metrics.begin()
 
-  # 返回给服务器
-  return response(environ, start_response)
+  # 开始统计本次请求内的数据库查询
+  token = profiler.begin()
+
+  try:
+    # 把请求传给框架的路由进行处理，并获取处理结果
+    try:
+      response = app.dispatch_request(request)
+    finally:
+      # 按请求匹配到的节点汇总查询统计
+      profiler.end(token, getattr(request, 'endpoint', None) or request.path)
+
+    # 响应生成之后，把本次请求修改过的会话一次性写入，签名 Cookie 会话会返回需要追加的 Set-Cookie 报头
+    headers = session.flush(request)
+  except Exception:
+    # 本次请求对会话的修改不再写入，解除未写入标记
+    session.discard(request)
+
+    # 没有被转换为响应体的异常，按 500 记录
+    metrics.record(scope, endpoint_of(request), request.method, 500)
+    raise
+
+  # 不记录指标且没有需要追加的报头时，直接返回给服务器
+  if scope is None and not headers:
+    return response(environ, start_response)
+
+  # 包装 start_response，记录状态码与响应大小，并追加报头，不修改响应体本身，因为异常响应体是全局共享的
+  endpoint = endpoint_of(request)
+  count = []
 
+  def start_response_with_headers(status, response_headers, exc_info=None):
+    if metrics.record(scope, endpoint, request.method, int(status[:3]), response_headers):
+      count.append(True)
+
+    return start_response(status, list(response_headers) + headers if headers else response_headers, exc_info)
+
+  app_iter = response(environ, start_response_with_headers)
+
+  # 没有 Content-Length 的响应在发送完后记录大小
+  if count:
+    return metrics.count_body(app_iter, endpoint)
+
+  # 返回给服务器
+  return app_iter
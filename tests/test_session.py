@@ -0,0 +1,111 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from aureus.session import session, create_session_id, SQLiteBackend
+
+
+# 只带有 Cookie 与请求环境的简易请求
+class FakeRequest:
+
+    def __init__(self, session_id):
+        self.cookies = {'session_id': session_id}
+        self.environ = {}
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'session.db'))
+    yield backend
+
+    # 恢复全局会话的默认配置
+    session.set_backend(None)
+    session.configure(max_sessions=10000)
+
+
+# 多个线程并发写入不同的键，会话数量远超内存容量时，全部修改都应写入存储后端
+@pytest.mark.parametrize('background', [False, True])
+@pytest.mark.parametrize('max_sessions', [10000, 4])
+def test_concurrent_writes_survive_eviction(backend, background, max_sessions):
+    session.set_backend(backend, background=background)
+    session.configure(max_sessions=max_sessions)
+
+    session_ids = [create_session_id() for _ in range(32)]
+    barrier = threading.Barrier(16)
+
+    def write(index):
+        if index < 16:
+            barrier.wait()
+
+        request = FakeRequest(session_ids[index % len(session_ids)])
+        session.push(request, 'key-%d' % index, index)
+        session.flush(request)
+
+    with ThreadPoolExecutor(16) as executor:
+        list(executor.map(write, range(1280)))
+
+    # 等待后台线程写完
+    if session.writer is not None:
+        session.writer.stop()
+        session.writer = None
+
+    stored = 0
+    for session_id in session_ids:
+        record = backend.load(session_id)
+        stored += len(record.data)
+
+    assert stored == 1280
+    assert session.pins == {}
+    if max_sessions == 4:
+        assert session.evicted > 0
+
+
+# 在子进程中轮流递增同一个会话中的计数器，每轮等待另一个进程完成后再继续
+def increment_in_turn(session_id, turn, done, rounds):
+    for _ in range(rounds):
+        turn.wait()
+        turn.clear()
+
+        request = FakeRequest(session_id)
+        session.push(request, 'counter', (session.get(request, 'counter') or 0) + 1)
+        session.flush(request)
+
+        done.set()
+
+
+# 多个进程共享存储后端时，每个进程都要读到其它进程写入的最新会话，不能用内存中的旧会话覆盖
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_shared_backend_across_processes(backend):
+    context = multiprocessing.get_context('fork')
+    session.set_backend(backend)
+    session.shared = True
+
+    session_id = create_session_id()
+    rounds = 10
+
+    # 两个进程都先把会话加载进内存
+    request = FakeRequest(session_id)
+    session.push(request, 'counter', 0)
+    session.flush(request)
+
+    turns = [context.Event(), context.Event()]
+    done = context.Event()
+    workers = [context.Process(target=increment_in_turn, args=(session_id, turn, done, rounds)) for turn in turns]
+
+    for worker in workers:
+        worker.start()
+
+    try:
+        for index in range(rounds * 2):
+            done.clear()
+            turns[index % 2].set()
+            assert done.wait(10)
+    finally:
+        for worker in workers:
+            worker.join(10)
+        session.shared = False
+
+    assert backend.load(session_id).data['counter'] == rounds * 2